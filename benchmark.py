@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+from ewenix.algorithms import Block, bubble, sort_by
+
+from time import perf_counter
+from random import randint
+from sys import argv
+
+def blocks(count):
+    return [Block(randint(0, 1023), randint(32, 255), randint(1, 224)) for _ in range(count)]
+
+def timed(fn, *args):
+    timer = perf_counter()
+    fn(*args)
+    return perf_counter() - timer
+
+def main():
+    # NOTE - bubble is quadratic, so only sizes up to this limit run it
+    limit = int(argv[1]) if len(argv) > 1 else 10000
+    for count in [10000, 100000, 1000000]:
+        xs = blocks(count)
+
+        fast = timed(sort_by, list(xs), "size")
+        top = timed(sort_by, xs, "size", 16)
+        slow = "skipped"
+        if count <= limit:
+            slow = f"{timed(bubble, list(xs), 2):.05f}s"
+
+        print(f"{count} blocks: sort_by {fast:.05f}s, top 16 {top:.05f}s, bubble {slow}")
+
+if __name__ == "__main__":
+    main()
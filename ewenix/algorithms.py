@@ -1,8 +1,16 @@
-from ewenix.structure import FileEntry, Encoder
-
-from math import log, ceil
+from ewenix.structure import FileEntry, Bitmap
+from ewenix.encoding import bload, bdump
+
+from math import ceil
+from time import perf_counter
+from heapq import heappush, heappop, nsmallest, nlargest
+from operator import itemgetter, attrgetter
+from bisect import bisect_left, insort
 from pathlib import Path
-from collections import namedtuple
+from mmap import mmap, PAGESIZE
+from os import stat
+from collections import namedtuple, OrderedDict
+from threading import RLock, Thread
 
 Block = namedtuple("Block", [
     "sector",
@@ -34,6 +42,41 @@ def bubble(xs, j=None, key=None):
 
     return xs
 
+def field(key):
+    """
+    Getter for item[key] on mappings and sequences, falling back to the
+    attribute named key so namedtuple fields work by name too
+    """
+
+    if key is None:
+        return None
+
+    if isinstance(key, int):
+        return itemgetter(key)
+
+    get = attrgetter(key)
+    def getter(x):
+        if isinstance(x, dict):
+            return x[key]
+
+        return get(x)
+
+    return getter
+
+def sort_by(xs, key=None, top=None, reverse=False):
+    """
+    Stable in-place sort of xs by item[key], or when top is given just the
+    top smallest (largest if reverse) items via a heap, in order
+    """
+
+    getter = field(key)
+    if top is not None:
+        select = nlargest if reverse else nsmallest
+        return select(top, xs, key=getter)
+
+    xs.sort(key=getter, reverse=reverse)
+    return xs
+
 class Span:
     def __init__(self, start, stop):
         self.start = start
@@ -48,28 +91,51 @@ class Buddy:
         self.clear()
 
     def clear(self):
-        power = ceil(log(self.size) / log(2))
-        self.free = list()
+        self.power = (self.size - 1).bit_length()
 
-        for i in range(power+1):
-            self.free.append(list())
+        # Free blocks per order, keyed by block address, with a heap of the
+        # same addresses (possibly stale) to find the lowest one quickly
+        self.free = list()
+        self.heaps = list()
+        for i in range(self.power+1):
+            self.free.append(set())
+            self.heaps.append(list())
 
-        self.free[power].append(Span(0, self.size-1))
+        self.orders = dict()
         self.pointers = dict()
+        self.push(0, self.power)
+
+    def push(self, start, order):
+        self.free[order].add(start)
+        heappush(self.heaps[order], start)
+
+    def lowest(self, order):
+        free = self.free[order]
+        heap = self.heaps[order]
+        while len(heap) > 0 and heap[0] not in free:
+            heappop(heap)
+
+        if len(heap) == 0:
+            return None
+
+        return heap[0]
+
+    def extent(self, start, order):
+        # NOTE - Blocks at the end may be cut short when size is not a power of 2
+        return min(1 << order, self.size - start)
 
     def alloc(self, size):
-        query = ceil(log(size) / log(2))
-        if query > len(self.free):
+        if size < 1:
             return True, "Out of bounds exception (1)"
 
-        if len(self.free[query]) > 0:
-            temp = self.free[query].pop(0)
-            self.pointers[temp.start] = temp.stop - temp.start + 1
-            return False, temp
+        query = (size - 1).bit_length()
+        if query > self.power:
+            return True, "Out of bounds exception (1)"
 
         index = None
-        for i in range(query+1, len(self.free)):
-            if len(self.free[i]) == 0:
+        for i in range(query, self.power+1):
+            start = self.lowest(i)
+            if start is None or self.extent(start, i) < size:
                 continue
 
             index = i
@@ -78,132 +144,119 @@ class Buddy:
         if index is None:
             return True, "Not enough memory to allocate"
 
-        temp = self.free[index].pop(0)
+        self.free[index].discard(start)
+        heappop(self.heaps[index])
 
         for i in range(index-1, query-1, -1):
-            # Split the span in half
-            span1 = Span(
-                temp.start,
-                temp.start + (temp.stop - temp.start) // 2
-            )
-            span2 = Span(
-                temp.start + (temp.stop - temp.start + 1) // 2,
-                temp.stop
-            )
-
-            # Add spans to the free blocks
-            self.free[i].append(span1)
-            self.free[i].append(span2)
-
-            # Remove a block for the next pass down
-            temp = self.free[i].pop(0)
-
-        self.pointers[temp.start] = temp.stop - temp.start + 1
-        return False, temp
-
-    def unalloc(self, pointer, psize=None):
-        size = self.pointers.get(pointer)
-        if address is None:
-            if psize is None:
-                return True, f"Cannot free unallocated address: {pointer}"
+            # Split the block in half, keeping the lower half for the next pass
+            buddy = start + (1 << i)
+            if buddy < self.size:
+                self.push(buddy, i)
 
-            # NOTE - Used when the pointer size is known in advance
-            for ptr, sze in self.pointers.items():
-                if pointer < ptr or pointer > ptr + sze:
-                    continue
+        extent = self.extent(start, query)
+        self.orders[start] = query
+        self.pointers[start] = extent
+        return False, Span(start, start + extent - 1)
 
-                # Removes the existing pointer
-                self.unalloc(ptr)
+    def unalloc(self, pointer):
+        order = self.orders.pop(pointer, None)
+        if order is None:
+            return True, f"Cannot free unallocated address: {pointer}"
 
-                # Create new entries split up from
-                self.load(ptr, pointer-1)
-                self.load(pointer, pointer+psize-1)
-                if pointer+psize-1 != ptr+sze-1:
-                    self.load(pointer+psize, ptr+sze-1)
+        self.pointers.pop(pointer, None)
 
-        query = ceil(log(size) / log(2))
-        self.free[query].append(Span(pointer, pointer + pow(2, query)-1))
+        # Merge with free buddies as far up the orders as they go
+        while order < self.power:
+            buddy = pointer ^ (1 << order)
+            if buddy < self.size:
+                if buddy not in self.free[order]:
+                    break
 
-        buddy = pointer / size
-        if buddy % 2 == 0:
-            ppointer = pointer + pow(2, query)
+                self.free[order].discard(buddy)
 
-        else:
-            ppointer = pointer - pow(2, query)
+            pointer = min(pointer, buddy)
+            order = order + 1
 
-        for i in range(len(self.free[query])):
-            # Buddy is not free
-            if self.free[query][i].start != baddress:
-                continue
+        self.push(pointer, order)
+        return False, None
 
-            if buddy % 2 == 0:
-                # Buddy is the block after the block with this address
-                self.free[query+1].append(Span(
-                    pointer,
-                    pointer + 2 * (pow(2, query)-1)
-                ))
+    def alloc_many(self, sizes):
+        spans = list()
+        for size in sizes:
+            error, result = self.alloc(size)
+            if error:
+                # Roll back so either every allocation happens or none do
+                for span in spans:
+                    self.unalloc(span.start)
 
-            else:
-                # Buddy is the block before the block with this address
-                self.free[query+1].append(Span(
-                    ppointer,
-                    ppointer + 2 * (pow(2, query)-1)
-                ))
-
-            self.free[query].pop(i)
-            self.free[query].pop(len(self.free[query])-1)
-            break
+                return True, result
 
-        self.pointers.pop(pointer, None)
-        return False, None
+            spans.append(result)
+
+        return False, spans
 
-    def load(self, start, stop):
-        span = Span(start, stop)
-        size = stop - start + 1
+    def unalloc_many(self, pointers):
+        pointers = list(pointers)
+        if len(set(pointers)) != len(pointers):
+            return True, "Cannot free the same address twice"
 
-        index = ceil(log(size) / log(2))
-        self.free[index].append(span)
-        self.pointers[start] = size
+        for pointer in pointers:
+            if pointer not in self.orders:
+                return True, f"Cannot free unallocated address: {pointer}"
+
+        for pointer in pointers:
+            self.unalloc(pointer)
+
+        return False, None
 
     def allocated(self, pointer):
         return self.pointers.get(pointer) is not None
 
+def as_bytes(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return False, data
+
+    try:
+        return False, bytes(data)
+
+    except ValueError:
+        byte = next(b for b in data if b < 0 or b > 255)
+        return True, f"{byte} is out of bounds"
+
+def coalesce(spans):
+    """
+    Merge (start, count) pairs into the fewest runs covering the same range
+    """
+
+    runs = list()
+    for start, count in sorted(spans):
+        if len(runs) > 0 and runs[-1][0] + runs[-1][1] == start:
+            runs[-1][1] = runs[-1][1] + count
+            continue
+
+        runs.append([start, count])
+
+    return runs
+
 class Memory:
     def __init__(self, size):
         self.size = size
         self.block = 32
-        self.offset = 128
+
+        # Reserve enough whole blocks up front for one allocation bit per block
+        bitmap = ceil(self.size // self.block / 8)
+        self.offset = ceil(bitmap / self.block) * self.block
 
         self.clear()
 
     def clear(self):
         self.owners = dict()
+        self.jobs = dict()
 
-        self.mem = [0] * self.size
-        self.blocks = Buddy(self.size // self.block)
-
-        # Reserve the first 128 bytes
-        self.blocks.alloc(self.offset // self.block, jobid=-1)
-
-    def assign(self, start, left, value):
-        k = start // 8
-        o = start % 8
-
-        while left > 0:
-            byte = self.mem[k]
-            bits = list(bin(byte)[2:])
-            if len(bits) < 8:
-                bits = (["0"] * (8-len(bits))) + bits
-
-            l = left if left < 8 else 8-o
-            left = left - l
-            for i in range(l):
-                bits[i+o] = value
-
-            self.mem[k] = int("".join(bits), 2)
-            if left > 0:
-                k = k+1
-                o = 0
+        self.mem = bytearray(self.size)
+        self.view = memoryview(self.mem)
+        self.blocks = Buddy((self.size - self.offset) // self.block)
+        self.bitmap = Bitmap(self.mem, 0, self.blocks.size)
 
     def alloc(self, size, jobid=None):
         error, result = self.blocks.alloc(size)
@@ -212,11 +265,11 @@ class Memory:
 
         span = result
         left = self.blocks.pointers.get(span.start)
-        self.assign(span.start, left, "1")
+        self.bitmap.set(span.start, left, True)
 
         address = span.start * self.block
         uaddress = address + self.offset
-        self.owners[uaddress] = jobid
+        self.own(uaddress, jobid)
         return False, uaddress
 
     def free(self, address, jobid=None):
@@ -230,8 +283,143 @@ class Memory:
         if error:
             return True, result
 
-        self.assign(pointer, left, "0")
-        self.owners.pop(address, None)
+        self.bitmap.set(pointer, left, False)
+        self.disown(address)
+        return False, result
+
+    def alloc_many(self, sizes, jobid=None):
+        error, result = self.blocks.alloc_many(sizes)
+        if error:
+            return True, result
+
+        spans = list()
+        addresses = list()
+        for span in result:
+            left = self.blocks.pointers.get(span.start)
+            spans.append((span.start, left))
+
+            uaddress = span.start * self.block + self.offset
+            self.own(uaddress, jobid)
+            addresses.append(uaddress)
+
+        for start, left in coalesce(spans):
+            self.bitmap.set(start, left, True)
+
+        return False, addresses
+
+    def free_many(self, addresses, jobid=None):
+        addresses = list(addresses)
+        for address in addresses:
+            if self.owners.get(address) != jobid:
+                return True, "Unauthorized memory address"
+
+        spans = list()
+        pointers = list()
+        for address in addresses:
+            pointer = (address - self.offset) // self.block
+            spans.append((pointer, self.blocks.pointers.get(pointer, 0)))
+            pointers.append(pointer)
+
+        error, result = self.blocks.unalloc_many(pointers)
+        if error:
+            return True, result
+
+        for start, left in coalesce(spans):
+            self.bitmap.set(start, left, False)
+
+        for address in addresses:
+            self.disown(address)
+
+        return False, None
+
+    def own(self, address, jobid):
+        self.owners[address] = jobid
+        self.jobs.setdefault(jobid, set()).add(address)
+
+    def disown(self, address):
+        jobid = self.owners.pop(address, None)
+        addresses = self.jobs.get(jobid)
+        if addresses is None:
+            return
+
+        addresses.discard(address)
+        if len(addresses) == 0:
+            del self.jobs[jobid]
+
+    def owned(self, jobid):
+        return self.jobs.get(jobid, set())
+
+    def release_job(self, jobid):
+        addresses = list(self.owned(jobid))
+        if len(addresses) == 0:
+            return False, 0
+
+        error, result = self.free_many(addresses, jobid=jobid)
+        if error:
+            return True, result
+
+        return False, len(addresses)
+
+    def compact(self):
+        """
+        Pack every live region down to the start of memory, returning a map
+        of old to new addresses along with the bytes moved and time taken
+        """
+
+        timer = perf_counter()
+
+        live = list()
+        for address, jobid in self.owners.items():
+            pointer = (address - self.offset) // self.block
+            left = self.blocks.pointers[pointer]
+            order = (left - 1).bit_length()
+            live.append((left < 1 << self.blocks.orders[pointer], order, left, address, jobid))
+
+        # Largest first so every region lands on an address aligned for its
+        # order, leaving any region cut short at the tail to go back there last
+        live.sort(key=lambda item: (item[0], -item[1], item[3]))
+
+        # NOTE - Placement is planned on a scratch pool so a failure changes nothing
+        blocks = Buddy(self.blocks.size)
+        plan = list()
+        for short, order, left, address, jobid in live:
+            error, result = blocks.alloc(left)
+            if error:
+                return True, f"Cannot compact region {address}: {result}"
+
+            plan.append((address, result.start, left, jobid))
+
+        snapshot = dict()
+        for address, start, left, jobid in plan:
+            size = left * self.block
+            snapshot[address] = bytes(self.view[address:address+size])
+
+        self.blocks = blocks
+        self.bitmap.clear(0, self.bitmap.size)
+        self.owners = dict()
+        self.jobs = dict()
+
+        moved = 0
+        spans = list()
+        relocations = dict()
+        for address, start, left, jobid in plan:
+            uaddress = start * self.block + self.offset
+            spans.append((start, blocks.pointers[start]))
+            self.own(uaddress, jobid)
+            relocations[address] = uaddress
+
+            if uaddress != address:
+                data = snapshot[address]
+                self.view[uaddress:uaddress+len(data)] = data
+                moved = moved + len(data)
+
+        for start, left in coalesce(spans):
+            self.bitmap.set(start, left, True)
+
+        result = dict()
+        result["relocations"] = relocations
+        result["moved"] = moved
+        result["time"] = perf_counter() - timer
         return False, result
 
     def write(self, address, data, jobid=None):
@@ -244,22 +432,25 @@ class Memory:
             address = result
             print(f"Dynamically allocated address: {address}")
 
-        if not self.blocks.allocated(address):
+        pointer = (address - self.offset) // self.block
+        if not self.blocks.allocated(pointer):
             return True, "Address is not allocated"
 
         if self.owners.get(address) != jobid:
             return True, "Unauthorized memory address"
 
-        for i in range(len(data)):
-            byte = data[i]
-            if byte < 0 or byte > 255:
-                return True, f"{byte} is out of bounds"
+        error, data = as_bytes(data)
+        if error:
+            return True, data
 
-            self.mem[address+i] = byte
+        size = len(data)
+        if size > self.blocks.pointers.get(pointer) * self.block:
+            return True, "Out of bounds exception (3)"
 
+        self.view[address:address+size] = data
         return False, address
 
-    def read(self, address, size, jobid=None):
+    def read(self, address, size, jobid=None, view=False):
         if address + size > len(self.mem):
             return True, "Out of bounds exception (2)"
 
@@ -271,253 +462,1048 @@ class Memory:
         if psize is None or psize * self.block < size:
             return True, "Unauthorized memory address (2)"
 
-        return False, self.mem[address:address+size]
+        if view:
+            return False, self.view[address:address+size]
 
-class Sector:
-    def __init__(self, size, path):
+        return False, list(self.view[address:address+size])
+
+class Slab:
+    def __init__(self, address, size, count, jobid=None):
+        self.address = address
         self.size = size
-        self.path = path
+        self.count = count
+        self.jobid = jobid
+
+        self.used = 0
+        self.free = [address + i * size for i in range(count-1, -1, -1)]
+
+    def live(self):
+        free = set(self.free)
+        for i in range(self.count):
+            address = self.address + i * self.size
+            if address not in free:
+                yield address
+
+    def __repr__(self):
+        return f"Slab<{self.address},{self.size},{self.used}>"
+
+class SlabAllocator:
+    """
+    Front-end to Memory that carves buddy blocks into fixed size objects,
+    keeping a cache of partially used slabs per job and size class, where
+    every size is in bytes and larger ones fall through to whole blocks
+    """
 
-        self.encoder = Encoder(["B"] * self.size)
+    def __init__(self, mem, classes=(4, 8, 16, 32, 64, 128), pages=4):
+        self.mem = mem
+        self.classes = classes
+        self.pages = pages
+
+        self.clear()
 
     def clear(self):
-        self.raw = [0] * self.size
+        self.partial = dict()
+        self.slabs = dict()
+        self.objects = dict()
+        self.requested = dict()
 
-        self.pull()
+    def reset(self):
+        self.mem.clear()
+        self.clear()
 
-    def push(self):
-        self.path.write_bytes(self.encoder.write(self.raw))
+    def klass(self, size):
+        for klass in self.classes:
+            if size <= klass:
+                return klass
 
-    def pull(self):
-        data = self.encoder.read(self.path.read_bytes())
-        for i, byte in enumerate(data):
-            self.raw[i] = ord(byte)
+        return None
 
-        # Pull the reserved bits for allocation
-        reserved = (self.size // self.block) // 8
-        allocation = self.raw[:reserved]
+    def alloc(self, size, jobid=None):
+        if size < 1:
+            return True, "Out of bounds exception (1)"
 
-        # Load in the pre-existing allocations
-        for byte in allocation:
-            bits = list(bin(byte)[2:])
-            if len(bits) < 8:
-                bits = (["0"] * (8-len(bits))) + bits
+        klass = self.klass(size)
+        if klass is None:
+            return self.mem.alloc(ceil(size / self.mem.block), jobid=jobid)
 
-            for bit in bits:
-                if bit == "1":
-                    s = s + 1
-                    continue
+        partial = self.partial.setdefault((jobid, klass), list())
+        if len(partial) == 0:
+            error, result = self.mem.alloc(self.pages, jobid=jobid)
+            if error:
+                return True, result
+
+            count = self.pages * self.mem.block // klass
+            slab = Slab(result, klass, count, jobid)
+            self.slabs[result] = slab
+            partial.append(slab)
+
+        slab = partial[-1]
+        address = slab.free.pop()
+        slab.used = slab.used + 1
+        if len(slab.free) == 0:
+            partial.pop()
+
+        self.objects[address] = slab
+        self.requested[address] = size
+        return False, address
+
+    def alloc_many(self, sizes, jobid=None):
+        addresses = list()
+        for size in sizes:
+            error, result = self.alloc(size, jobid=jobid)
+            if error:
+                # Roll back so either every allocation happens or none do
+                for address in addresses:
+                    self.free(address, jobid=jobid)
+
+                return True, result
+
+            addresses.append(result)
+
+        return False, addresses
+
+    def free_many(self, addresses, jobid=None):
+        addresses = list(addresses)
+        if len(set(addresses)) != len(addresses):
+            return True, "Cannot free the same address twice"
+
+        for address in addresses:
+            slab = self.objects.get(address)
+            owner = self.mem.owners.get(address) if slab is None else slab.jobid
+            if owner != jobid or address in self.slabs:
+                return True, "Unauthorized memory address"
+
+        for address in addresses:
+            self.free(address, jobid=jobid)
+
+        return False, None
+
+    def free(self, address, jobid=None):
+        slab = self.objects.get(address)
+        if slab is None:
+            if address in self.slabs:
+                return True, "Cannot free a slab directly"
+
+            return self.mem.free(address, jobid=jobid)
+
+        if slab.jobid != jobid:
+            return True, "Unauthorized memory address"
+
+        partial = self.partial[(jobid, slab.size)]
+        if len(slab.free) == 0:
+            partial.append(slab)
+
+        slab.free.append(address)
+        slab.used = slab.used - 1
+        self.objects.pop(address)
+        self.requested.pop(address)
+
+        # Hand empty slabs back to the buddy allocator
+        if slab.used == 0:
+            partial.remove(slab)
+            self.slabs.pop(slab.address)
+            return self.mem.free(slab.address, jobid=jobid)
+
+        return False, None
+
+    def release_job(self, jobid):
+        for address in self.mem.owned(jobid):
+            slab = self.slabs.pop(address, None)
+            if slab is None:
+                continue
+
+            for obj in slab.live():
+                self.objects.pop(obj)
+                self.requested.pop(obj)
+
+        self.partial = {
+            key: partial
+            for key, partial in self.partial.items()
+            if key[0] != jobid
+        }
+
+        return self.mem.release_job(jobid)
+
+    def compact(self):
+        error, result = self.mem.compact()
+        if error:
+            return True, result
+
+        relocations = result["relocations"]
+
+        # Objects move along with the slab they were carved from
+        slabs = dict()
+        objects = dict()
+        requested = dict()
+        for address, slab in self.slabs.items():
+            delta = relocations[address] - address
+            for obj in slab.live():
+                objects[obj + delta] = slab
+                requested[obj + delta] = self.requested[obj]
+                relocations[obj] = obj + delta
+
+            slab.address = slab.address + delta
+            slab.free = [obj + delta for obj in slab.free]
+            slabs[slab.address] = slab
+
+        self.slabs = slabs
+        self.objects = objects
+        self.requested = requested
+        return False, result
+
+    def write(self, address, data, jobid=None):
+        if address == -1:
+            error, result = self.alloc(len(data), jobid=jobid)
+            if error:
+                return True, result
+
+            address = result
+            print(f"Dynamically allocated address: {address}")
+
+        slab = self.objects.get(address)
+        if slab is None:
+            return self.mem.write(address, data, jobid=jobid)
+
+        if slab.jobid != jobid:
+            return True, "Unauthorized memory address"
 
-                if s > 0:
-                    self.blocks.alloc(s)
-                    s = 0
+        error, data = as_bytes(data)
+        if error:
+            return True, data
+
+        size = len(data)
+        if size > slab.size:
+            return True, "Out of bounds exception (3)"
+
+        self.mem.view[address:address+size] = data
+        return False, address
+
+    def read(self, address, size, jobid=None, view=False):
+        slab = self.objects.get(address)
+        if slab is None:
+            return self.mem.read(address, size, jobid=jobid, view=view)
+
+        if slab.jobid != jobid:
+            return True, "Unauthorized memory address (1)"
+
+        if size > slab.size:
+            return True, "Unauthorized memory address (2)"
+
+        if view:
+            return False, self.mem.view[address:address+size]
+
+        return False, list(self.mem.view[address:address+size])
+
+    def stats(self):
+        """
+        Internal fragmentation per size class as requested and reserved bytes
+        """
+
+        stats = dict()
+        for klass in self.classes:
+            stats[klass] = {"objects": 0, "requested": 0, "reserved": 0}
+
+        for slab in self.slabs.values():
+            stats[slab.size]["reserved"] += self.pages * self.mem.block
+
+        for address, size in self.requested.items():
+            entry = stats[self.objects[address].size]
+            entry["objects"] += 1
+            entry["requested"] += size
+
+        for entry in stats.values():
+            reserved = entry["reserved"]
+            wasted = reserved - entry["requested"]
+            entry["fragmentation"] = wasted / reserved if reserved else 0.0
+
+        return stats
+
+class FreeIndex:
+    """
+    Free extents kept ordered by size for best-fit lookups and by address
+    for merging neighbours on free
+    """
+
+    def __init__(self, extents=None):
+        self.clear()
+        for start, size in extents or list():
+            self.add(start, size)
+
+    def clear(self):
+        self.sizes = list()
+        self.starts = list()
+        self.extents = dict()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def total(self):
+        return sum(self.extents.values())
+
+    def add(self, start, size):
+        insort(self.sizes, (size, start))
+        insort(self.starts, start)
+        self.extents[start] = size
+
+    def remove(self, start):
+        size = self.extents.pop(start)
+        del self.sizes[bisect_left(self.sizes, (size, start))]
+        del self.starts[bisect_left(self.starts, start)]
+        return size
+
+    def fit(self, size):
+        """
+        Smallest extent holding at least size units, lowest address first
+        """
+
+        i = bisect_left(self.sizes, (size, -1))
+        if i == len(self.sizes):
+            return None
+
+        return self.sizes[i]
+
+    def take(self, size):
+        if size <= 0:
+            return True, "Size must be positive"
+
+        best = self.fit(size)
+        if best is None:
+            return True, "Not enough free space"
+
+        extent, start = best
+        self.remove(start)
+        if extent > size:
+            self.add(start + size, extent - size)
+
+        return False, start
+
+    def put(self, start, size):
+        i = bisect_left(self.starts, start)
+        if i > 0:
+            before = self.starts[i-1]
+            if before + self.extents[before] > start:
+                return True, f"Extent {start} is already free"
+
+        if i < len(self.starts) and self.starts[i] < start + size:
+            return True, f"Extent {start} is already free"
+
+        if i > 0 and before + self.extents[before] == start:
+            start, size = before, self.remove(before) + size
+
+        if start + size in self.extents:
+            size = size + self.remove(start + size)
 
-            if s > 0:
-                self.blocks.alloc(s)
+        self.add(start, size)
+        return False, (start, size)
+
+    def pairs(self):
+        pairs = list()
+        for start in self.starts:
+            pairs.extend([start, self.extents[start]])
+
+        return pairs
+
+class Sector:
+    def __init__(self, size, path):
+        self.size = size
+        self.path = path
+
+    def clear(self, data=None):
+        self.raw = bytearray(self.size)
+
+        # Bytes 4-31 track the allocation of each data byte after them
+        self.bitmap = Bitmap(self.raw, 4, self.size - 32)
+
+        if data is None:
+            self.pull()
+
+        else:
+            self.raw[:len(data)] = data
+
+    def push(self, path=None):
+        path = self.path if path is None else path
+        path.write_bytes(self.raw)
+
+    def pull(self, path=None):
+        path = self.path if path is None else path
+        if not path.exists():
+            return
+
+        data = path.read_bytes()[:self.size]
+        self.raw[:len(data)] = data
 
     def write(self, address, data):
         size = len(data)
-        for i in range(size):
-            byte = data[i]
-            if byte < 0 or byte > 255:
-                return True, f"{byte} is out of bounds"
+        if address < 0 or address + size > self.size:
+            return True, "Out of bounds exception"
 
-            self.raw[address+i] = byte
+        error, result = as_bytes(data)
+        if error:
+            return True, result
 
+        self.raw[address:address+size] = result
         return False, address
 
     def read(self, address, size):
-        if address + size > len(self.raw):
+        if address < 0 or address + size > self.size:
             return True, "Out of bounds exception"
 
-        return False, self.raw[address:address+size]
+        return False, bytes(self.raw[address:address+size])
 
 class Storage:
-    def __init__(self, sectors, size, root=None):
+    """
+    Sectors kept in a single memory-mapped disk image behind a bounded
+    write-back cache, so changes only reach the disk on eviction or flush
+    """
+
+    def __init__(self, sectors, size, root=None, image=True, cache=64):
         self.sector_count = sectors
         self.sector_size = size
-        self.root = None
+        self.root = root
+        self.image = image
+        self.limit = max(1, cache)
+
+        self.file = None
+        self.map = None
+        self.view = None
+
+        self.cache = OrderedDict()
+        self.dirty = set()
+        self.unsynced = set()
+        self.reset_stats()
+
+    @property
+    def size(self):
+        return self.sector_count * self.sector_size
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        self.flushes = 0
+        self.runs = 0
+        self.flushed = 0
 
     def clear(self):
+        self.close()
+
         if self.root is None:
             self.root = Path.cwd() / "store"
 
         if not self.root.exists():
             self.root.mkdir(parents=True, exist_ok=True)
 
-        self.sectors = list()
-        for i in range(self.sector_count):
-            path = self.root / f"{i}.bin"
-            sector = Sector(self.sector_size, path)
-            self.sectors.append(rsector)
+        if self.image:
+            self.open()
+
+    def open(self):
+        path = self.root / "disk.img"
+        if not path.exists():
+            path.touch()
+
+        self.file = path.open("r+b")
+        if stat(self.file.fileno()).st_size < self.size:
+            self.file.truncate(self.size)
+
+        self.map = mmap(self.file.fileno(), self.size)
+        self.view = memoryview(self.map)
 
-    #def alloc(self, size):
-    #    error, result = self.raw.alloc(size)
-    #    if error:
-    #        return True, result
+    def close(self):
+        self.flush()
+        self.cache = OrderedDict()
+        self.unsynced = set()
+        if self.map is None:
+            return
 
-    #    span = result
-    #    address = span.start
+        self.view.release()
+        self.view = None
 
-    #    sector_index = address // self.sector_size
-    #    sector_offset = address % self.sector_size
+        self.map.close()
+        self.map = None
 
-    #    cache = None
-    #    while True:
-    #        sector = self.sectors[sector_index]
-    #        sector_left = sector.size - sector_offset
-    #        if len(data) > sector_left:
-    #            data, cache = data[:sector_left], data[sector_left:]
+        self.file.close()
+        self.file = None
 
-    #        sector.write(sector_offset, data)
-    #        if cache is None:
-    #            break
+    def path(self, index, root=None):
+        root = self.root if root is None else root
+        return root / f"{index}.bin"
 
-    #        sector_index = sector_index + 1
-    #        sector_offset = 0
-    #        data = cache
-    #        cache = None
+    def load(self, index):
+        sector = Sector(self.sector_size, self.path(index))
+        if self.view is None:
+            sector.clear()
+
+        else:
+            start = index * self.sector_size
+            sector.clear(self.view[start:start+self.sector_size])
+
+        return sector
+
+    def sector(self, index):
+        """
+        Sector at index from the cache, paging it in on a miss
+        """
+
+        sector = self.cache.get(index)
+        if sector is not None:
+            self.hits = self.hits + 1
+            self.cache.move_to_end(index)
+            return sector
+
+        self.misses = self.misses + 1
+        sector = self.load(index)
+        self.cache[index] = sector
+        if len(self.cache) > self.limit:
+            self.evict()
+
+        return sector
+
+    def evict(self):
+        index, sector = self.cache.popitem(last=False)
+        self.evictions = self.evictions + 1
+        if index in self.dirty:
+            self.dirty.discard(index)
+            self.writebacks = self.writebacks + 1
+            self.store(index, [sector])
+
+            # NOTE - Written into the mapping but not synced until the next flush
+            if self.map is not None:
+                self.unsynced.add(index)
+
+    def touch(self, index):
+        """
+        Mark a cached sector as changed so it is written back later
+        """
+
+        self.dirty.add(index)
+
+    def store(self, index, sectors):
+        if self.view is None:
+            for sector in sectors:
+                sector.push()
+
+            return
+
+        start = index * self.sector_size
+        end = start + len(sectors) * self.sector_size
+        self.view[start:end] = b"".join(sector.raw for sector in sectors)
+
+    def flush(self, start=0, stop=None):
+        """
+        Write back dirty sectors in [start, stop) as runs of adjacent sectors
+        in index order, then sync the range to disk
+        """
+
+        stop = self.sector_count if stop is None else stop
+        indexes = sorted(i for i in self.dirty if start <= i < stop)
+        evicted = [i for i in self.unsynced if start <= i < stop]
+        if len(indexes) == 0 and len(evicted) == 0:
+            return False, 0
+
+        self.flushes = self.flushes + 1
+
+        runs = list()
+        for index in indexes:
+            if len(runs) > 0 and runs[-1][0] + len(runs[-1][1]) == index:
+                runs[-1][1].append(self.cache[index])
+
+            else:
+                runs.append((index, [self.cache[index]]))
+
+        for index, sectors in runs:
+            self.store(index, sectors)
+
+        self.dirty.difference_update(indexes)
+        self.runs = self.runs + len(runs)
+        self.flushed = self.flushed + len(indexes)
+
+        if self.map is not None:
+            # Sync everything written since the last flush, evictions included
+            first = min(indexes + evicted)
+            last = max(indexes + evicted)
+            self.unsynced.difference_update(evicted)
+
+            # msync needs the offset aligned to a page
+            offset = first * self.sector_size
+            aligned = offset - offset % PAGESIZE
+            end = (last + 1) * self.sector_size
+            self.map.flush(aligned, end - aligned)
+
+        return False, len(runs)
+
+    def stats(self):
+        stats = dict()
+        lookups = self.hits + self.misses
+        stats["hits"] = self.hits
+        stats["misses"] = self.misses
+        stats["hit_rate"] = self.hits / lookups if lookups else 0.0
+        stats["evictions"] = self.evictions
+        stats["writebacks"] = self.writebacks
+        stats["flushes"] = self.flushes
+        stats["runs"] = self.runs
+        stats["flushed"] = self.flushed
+        stats["cached"] = len(self.cache)
+        stats["dirty"] = len(self.dirty)
+        stats["limit"] = self.limit
+        return stats
+
+    def export_files(self, root=None):
+        root = self.root if root is None else root
+        root.mkdir(parents=True, exist_ok=True)
+        for i in range(self.sector_count):
+            sector = self.cache.get(i)
+            if sector is None:
+                sector = self.load(i)
 
-    #    return False, address
+            sector.push(self.path(i, root))
+
+        return False, self.sector_count
+
+    def import_files(self, root=None):
+        root = self.root if root is None else root
+        for i in range(self.sector_count):
+            sector = self.sector(i)
+            sector.pull(self.path(i, root))
+            self.touch(i)
+
+        self.flush()
+        return False, self.sector_count
+
+    def bounds(self, address, size):
+        return address < 0 or size < 0 or address + size > self.size
 
     def write(self, address, data):
-        #if not self.raw.allocated(address):
-        #    return True, "Address is not allocated"
+        if self.bounds(address, len(data)):
+            return True, "Out of bounds exception"
 
-        #if len(data) > self.raw.pointers.get(address, 0):
-        #    return True, "Out of bounds exception (1)"
+        error, data = as_bytes(data)
+        if error:
+            return True, data
 
         sector_index = address // self.sector_size
         sector_offset = address % self.sector_size
 
-        cache = None
-        while True:
-            sector = self.sectors[sector_index]
-            sector_left = sector.size - sector_offset
-            if len(data) > sector_left:
-                data, cache = data[:sector_left], data[sector_left:]
-
-            sector.write(sector_offset, data)
-            if cache is None:
-                break
+        start = 0
+        while start < len(data):
+            sector = self.sector(sector_index)
+            request = min(len(data) - start, sector.size - sector_offset)
+            sector.write(sector_offset, data[start:start+request])
+            self.touch(sector_index)
 
+            start = start + request
             sector_index = sector_index + 1
             sector_offset = 0
-            data = cache
-            cache = None
 
         return False, address
 
     def read(self, address, size):
+        if self.bounds(address, size):
+            return True, "Out of bounds exception"
+
         sector_index = address // self.sector_size
         sector_offset = address % self.sector_size
 
-        read = list()
+        read = bytearray()
         while size > 0:
-            sector = self.sectors[sector_index]
-            sector_left = sector.size - sector_offset
-            request = size
-            if size > sector_left:
-                request = sector_left
-                size = size - sector_left
-
-            else:
-                size = 0
+            sector = self.sector(sector_index)
+            request = min(size, sector.size - sector_offset)
+            size = size - request
 
             error, result = sector.read(sector_offset, request)
             if error:
                 return True, result
 
-            if read is not None:
-                read = read + result
-
+            read.extend(result)
             sector_index = sector_index + 1
             sector_offset = 0
 
-        return False, read
+        return False, bytes(read)
 
 class FileSystem:
-    def __init__(self, storage, size):
+    """
+    File system over Storage, where a lazy mount only reads the superblock
+    and free index, paging every other sector in on first touch
+    """
+
+    MAGIC = b"EWF"
+
+    # Superblock byte after the magic, dirty until the free index is synced
+    CLEAN = 0
+    DIRTY = 1
+
+    # Bytes of the superblock before the free index starts
+    HEADER = 4
+
+    def __init__(self, storage, size, lazy=True, prefetch=False):
         self.storage = storage
         self.size = size
+        self.lazy = lazy
 
         self.block = 32
 
         self.st_offset = 128 # Sector offset
         self.se_offset = 32 # Bytes offset in sector
+        self.reserved = 32 # Sectors at the end for the superblock and free index
 
+        # NOTE - Held by every path touching storage, since a page from the
+        # prefetcher can evict a sector another path is still changing
+        self.lock = RLock()
+        self.prefetcher = None
         self.clear()
 
+        if prefetch:
+            self.prefetcher = Thread(target=self.prefetch, daemon=True)
+            self.prefetcher.start()
+
     def clear(self):
         self.storage.clear()
         self.load()
 
     def load(self):
-        index = 0
+        with self.lock:
+            return self.mount()
+
+    def mount(self):
+        count = self.storage.sector_count
+        self.entries = self.storage.sector_size // self.se_offset
+        self.units = self.storage.sector_size - 32
+
+        # Data sectors sit between the directory and the reserved metadata
+        self.first = min(self.st_offset, count)
+        self.last = max(self.first, count - self.reserved)
+
+        self.table = [None] * count
+        self.fblocks = [None] * (self.first * self.entries)
+        self.paged = set()
+
+        # NOTE - The first reserved sector is the superblock, while the root
+        # directory entry is the first entry of sector 0
+        error, result = self.page(0)
+        if error:
+            return True, result
+
+        error, result = self.load_index()
+        if error:
+            self.rebuild()
+            self.live = self.recover(self.live)
+
+        if not self.lazy:
+            for index in range(count):
+                self.page(index)
+
+        return False, None
+
+    def page(self, index):
+        """
+        Read the free table and file entries of a sector the first time it
+        is touched
+        """
+
+        if index in self.paged:
+            return False, index
+
+        with self.lock:
+            if index in self.paged:
+                return False, index
+
+            sector = self.storage.sector(index)
+
+            # NOTE - Only data sectors carry an allocation bitmap
+            table = dict()
+            if self.first <= index < self.last:
+                for start, block in sector.bitmap.runs():
+                    table[start+32] = block
+
+            if index < self.first:
+                for j in range(self.entries):
+                    address = j * self.se_offset
+                    error, entry = sector.read(address, self.se_offset)
+                    if error:
+                        return True, entry
+
+                    # Detect if file system entry is set or not
+                    if entry[0] < 128:
+                        continue
+
+                    fblock = FileEntry.init(entry)
+                    fblock.attach(sector, address)
+                    self.fblocks[index * self.entries + j] = fblock
+
+            self.table[index] = table
+            self.paged.add(index)
+
+        return False, index
+
+    def prefetch(self):
+        for index in range(self.first):
+            self.page(index)
+
+    @property
+    def root(self):
+        return self.fblocks[0]
+
+    def entry(self, number):
+        error, result = self.page(number // self.entries)
+        if error:
+            return True, result
+
+        return False, self.fblocks[number]
+
+    def free_runs(self, index):
+        error, result = self.page(index)
+        if error:
+            return True, result
+
+        return False, self.table[index]
+
+    def locate(self, unit, size):
+        return Block(unit // self.units, unit % self.units + 32, size)
+
+    @property
+    def blocks(self):
+        return [self.locate(start, size) for size, start in self.index.sizes]
+
+    def scan(self):
+        """
+        Merge the free runs of every data sector into blocks, smallest first
+        """
+
         cache = None
         blocks = dict()
+        for index in range(self.first, self.last):
+            self.page(index)
 
-        self.table = list()
-        for sector in self.storage.sectors:
-            sector.pull()
+            carry = cache
+            cache = None
+            for start, block in self.table[index].items():
+                start = start - 32
+
+                key = index, start+32
+                size = block
+                if start == 0 and carry is not None:
+                    # Free space continues on from the previous sector
+                    key = carry
+                    size = blocks[key] + block
+
+                blocks[key] = size
+                if start + block == self.units:
+                    cache = key
+
+        blocks = [Block(index, start, block) for (index, start), block in blocks.items()]
+        return sort_by(blocks, "size")
+
+    def rebuild(self):
+        self.index = FreeIndex()
+        for sector, offset, size in self.scan():
+            self.index.add(sector * self.units + offset - 32, size)
+
+        self.changed = True
+        self.state(self.DIRTY)
+
+    def recover(self, saved):
+        """
+        Live allocations after a rescan, keeping saved ones that still fit in
+        the used space and treating any other used run as one allocation
+        """
+
+        used = list()
+        cursor = self.first * self.units
+        for start in self.index.starts:
+            if start > cursor:
+                used.append((cursor, start))
+
+            cursor = start + self.index.extents[start]
+
+        if cursor < self.last * self.units:
+            used.append((cursor, self.last * self.units))
+
+        live = dict()
+        saved = sorted(saved.items())
+        i = 0
+        for low, high in used:
+            cursor = low
+            while i < len(saved) and saved[i][0] < high:
+                start, size = saved[i]
+                i = i + 1
+                if start < cursor or start + size > high:
+                    continue
 
-            table = dict()
-            error, result = sector.read(4, 28)
+                if start > cursor:
+                    live[cursor] = start - cursor
+
+                live[start] = size
+                cursor = start + size
+
+            if cursor < high:
+                live[cursor] = high - cursor
+
+        return live
+
+    def state(self, value):
+        sector = self.storage.sector(self.last)
+        if sector.raw[3] != value:
+            sector.raw[3] = value
+            self.storage.touch(self.last)
+
+    def modify(self):
+        if not self.changed:
+            self.changed = True
+            self.state(self.DIRTY)
+
+    def load_index(self):
+        """
+        Read the free index from the reserved sectors, formatting the disk
+        when the superblock has never been written
+        """
+
+        sector = self.storage.sector(self.last)
+        if bytes(sector.raw[:3]) != self.MAGIC:
+            sector.raw[:3] = self.MAGIC
+            self.storage.touch(self.last)
+
+            self.index = FreeIndex()
+            if self.last > self.first:
+                start = self.first * self.units
+                self.index.add(start, (self.last - self.first) * self.units)
+
+            self.live = dict()
+            self.changed = True
+            self.state(self.DIRTY)
+            return False, self.index
+
+        self.live = dict()
+        dirty = sector.raw[3] != self.CLEAN
+
+        # Read one more sector at a time until the index decodes in full
+        meta = None
+        size = self.storage.sector_size
+        start = self.last * size + self.HEADER
+        for count in range(1, self.reserved + 1):
+            error, raw = self.storage.read(start, count * size - self.HEADER)
             if error:
-                return True, result
+                return True, raw
 
-            count = 0
-            block = 0
-            start = None
-            for byte in result:
-                bits = list(bin(byte)[2:])
-                for bit in bits:
-                    free = bit == "0"
-                    if free:
-                        block = block + 1
-                        if start is None:
-                            start = count
+            try:
+                offset, meta = bload(raw)
+                break
 
-                    elif not free and block > 0:
-                        table[start+32] = block
-                        blocks[(index, start+32)] = block
+            except ValueError:
+                continue
 
-                        start = None
-                        block = 0
+        try:
+            allocated = meta["allocated"]
 
-                        if cache is not None:
-                            c_index, c_start, c_block = cache
-                            blocks[(c_index, c_start)] = c_block + block
-                            cache = None
+        except (KeyError, TypeError):
+            return True, "Free index is missing or corrupt"
 
-                    count = count + 1
+        # Allocations are saved as the gap before each one and its size, and
+        # the free extents are exactly the gaps between them
+        extents = list()
+        cursor = self.first * self.units
+        for gap, size in zip(allocated[::2], allocated[1::2]):
+            if gap > 0:
+                extents.append((cursor, gap))
 
-            if block > 0:
-                cache = index, start+32, block
+            self.live[cursor + gap] = size
+            cursor = cursor + gap + size
 
-            index = index + 1
-            self.table.append(table)
+        if cursor < self.last * self.units:
+            extents.append((cursor, self.last * self.units - cursor))
 
-        self.blocks = list()
-        for (index, start), block in blocks.items():
-            self.blocks.append(Block(index, start, block))
+        # NOTE - Bitmaps may have reached the disk after the index was saved,
+        # though the stale allocations are still worth handing to recover
+        if dirty:
+            return True, "Free index is older than the bitmaps"
 
-        bubble(self.blocks, "size")
+        self.index = FreeIndex(extents)
+        self.changed = False
+        return False, self.index
 
-        self.fblocks = list()
-        for i in range(self.st_offset):
-            sector = self.storage.sectors[i]
+    def store_index(self):
+        size = self.storage.sector_size
+        area = self.reserved * size - self.HEADER
 
-            for j in range(sector.size // self.se_offset):
-                address = j * self.se_offset
-                entry = sector.read(address, self.se_offset)
+        meta = dict()
+        meta["allocated"] = list()
+        cursor = self.first * self.units
+        for start, length in sorted(self.live.items()):
+            meta["allocated"].extend([start - cursor, length])
+            cursor = start + length
 
-                # Detect if file system entry is set or not
-                if entry[0] < 128:
-                    self.fblocks.append(None)
-                    continue
+        raw = bdump(meta)
+        if len(raw) > area:
+            # NOTE - Too fragmented to persist, so the next mount rescans
+            raw = b"\x00"
+
+        error, result = self.storage.write(self.last * size + self.HEADER, raw)
+        if error:
+            return True, result
 
-                fblock = FileEntry.init(entry)
-                fblock.attach(sector)
-                self.fblocks.append(fblock)
+        self.state(self.CLEAN)
+        self.changed = False
+        return False, len(raw)
+
+    def sync(self):
+        with self.lock:
+            if self.changed:
+                error, result = self.store_index()
+                if error:
+                    return True, result
+
+            return self.storage.flush()
+
+    def mark(self, unit, size, value):
+        while size > 0:
+            index = unit // self.units
+            start = unit % self.units
+            count = min(size, self.units - start)
+
+            sector = self.storage.sector(index)
+            sector.bitmap.set(start, count, value)
+            self.storage.touch(index)
+
+            if index in self.paged:
+                table = dict()
+                for run, block in sector.bitmap.runs():
+                    table[run+32] = block
+
+                self.table[index] = table
+
+            unit = unit + count
+            size = size - count
+
+    def alloc(self, size):
+        """
+        Best-fit allocation of size data bytes, returned as a Block
+        """
+
+        with self.lock:
+            error, result = self.index.take(size)
+            if error:
+                return True, result
+
+            self.modify()
+            self.mark(result, size, True)
+            self.live[result] = size
+            return False, self.locate(result, size)
+
+    def free(self, block):
+        sector, offset, size = block
+        unit = sector * self.units + offset - 32
+        if unit < self.first * self.units or unit + size > self.last * self.units:
+            return True, f"Block {block} is outside of the data sectors"
+
+        with self.lock:
+            # NOTE - Only whole blocks handed out by alloc can be freed
+            if self.live.get(unit) != size:
+                return True, f"Block {block} was not allocated"
+
+            error, result = self.index.put(unit, size)
+            if error:
+                return True, result
 
+            del self.live[unit]
+            self.modify()
+            self.mark(unit, size, False)
+            return False, block
@@ -1,106 +1,264 @@
 from enum import Enum, auto
 from json import loads
+from re import compile as rcompile
 
 DONE = "%DONE%"
 
+BINT = rcompile(rb"i(-?\d+)e")
+BLEN = rcompile(rb"(\d+):")
+
 class BMode(Enum):
     INT  = auto()
     LIST = auto()
     DICT = auto()
     BYTE = auto()
 
-def bdecode(data):
-    if len(data) == 0:
-        return
-
-    char = data[0]
-    data = data[1:]
+def bload(data, offset=0):
+    """
+    Decode one value from bytes-like data starting at offset, returning the
+    offset just past the value along with the value itself
+    """
 
-    if char == "e":
-        return data, DONE
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
 
-    if char == "i":
-        cache = ""
-        while True:
-            char = data[0]
-            data = data[1:]
+    if offset >= len(data):
+        raise ValueError(f"Unexpected end of data at {offset}")
 
-            if char == "e":
-                return data, int(cache)
+    char = data[offset]
+    if char == 0x69: # i
+        match = BINT.match(data, offset)
+        if match is None:
+            raise ValueError(f"Invalid integer at {offset}")
 
-            cache = cache + char
+        return match.end(), int(match.group(1))
 
-    elif char == "l":
+    elif char == 0x6c: # l
+        offset = offset + 1
         final = list()
         while True:
-            data, value = bdecode(data)
-            if value == DONE:
-                break
+            if offset >= len(data):
+                raise ValueError(f"Unterminated list at {offset}")
 
-            final.append(value)
+            if data[offset] == 0x65: # e
+                return offset + 1, final
 
-        return data, final
+            offset, value = bload(data, offset)
+            final.append(value)
 
-    elif char == "d":
+    elif char == 0x64: # d
+        offset = offset + 1
         final = dict()
-        key = None
         while True:
-            data, value = bdecode(data)
-            if value == DONE:
-                break
+            if offset >= len(data):
+                raise ValueError(f"Unterminated dict at {offset}")
 
-            if key is None:
-                key = value
-                continue
+            if data[offset] == 0x65: # e
+                return offset + 1, final
 
+            offset, key = bload(data, offset)
+            offset, value = bload(data, offset)
             final[key] = value
-            key = None
 
-        return data, final
+    match = BLEN.match(data, offset)
+    if match is None:
+        raise ValueError(f"Invalid string at {offset}")
 
-    else:
-        size = None
-        cache = char
-        while True:
-            char = data[0]
-            data = data[1:]
+    start = match.end()
+    stop = start + int(match.group(1))
+    if stop > len(data):
+        raise ValueError(f"String overruns data at {offset}")
+
+    return stop, bytes(data[start:stop]).decode("utf-8")
+
+def bdecode(data):
+    if len(data) == 0:
+        return
+
+    if isinstance(data, str):
+        # NOTE - String lengths count UTF-8 bytes, not characters
+        raw = data.encode("utf-8")
+        offset, value = bload(raw)
+        return raw[offset:].decode("utf-8"), value
+
+    offset, value = bload(data)
+    return data[offset:], value
+
+class BParser:
+    """
+    Push parser for bencode that accepts data in chunks of any size, keeping
+    an explicit stack for nesting so depth is not bound by recursion
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.buffer = bytearray()
+        self.stack = list()
+
+    @property
+    def pending(self):
+        return len(self.stack) > 0 or len(self.buffer) > 0
+
+    def feed(self, chunk):
+        """
+        Consume the chunk and return the list of top level values completed
+        """
 
-            if size is None and char == ":":
-                size = int(cache)
-                cache = ""
+        self.buffer.extend(chunk)
+
+        values = list()
+        data = self.buffer
+        offset = 0
+        while offset < len(data):
+            char = data[offset]
+            if char == 0x65: # e
+                if len(self.stack) == 0:
+                    raise ValueError(f"Unexpected end marker at {offset}")
+
+                container, key = self.stack.pop()
+                if key is not DONE:
+                    raise ValueError(f"Dict key without value at {offset}")
+
+                offset = offset + 1
+                value = container
+
+            elif char == 0x6c: # l
+                self.stack.append((list(), DONE))
+                offset = offset + 1
                 continue
 
-            cache = cache + char
-            if size is not None and len(cache) == size:
-                return data, cache
+            elif char == 0x64: # d
+                self.stack.append((dict(), DONE))
+                offset = offset + 1
+                continue
 
-    return data, DONE
+            elif char == 0x69: # i
+                stop = data.find(b"e", offset)
+                if stop == -1:
+                    break
 
-def bencode(data, enc=False):
-    if enc:
-        data = loads(data)
+                match = BINT.match(data, offset, stop+1)
+                if match is None:
+                    raise ValueError(f"Invalid integer at {offset}")
+
+                offset = match.end()
+                value = int(match.group(1))
+
+            else:
+                stop = data.find(b":", offset)
+                if stop == -1:
+                    break
+
+                match = BLEN.match(data, offset, stop+1)
+                if match is None:
+                    raise ValueError(f"Invalid string at {offset}")
+
+                start = match.end()
+                end = start + int(match.group(1))
+                if end > len(data):
+                    break
+
+                offset = end
+                value = bytes(data[start:end]).decode("utf-8")
+
+            self._emit(value, values)
+
+        # Drop consumed bytes so the buffer only holds a partial token
+        if offset > 0:
+            del data[:offset]
+
+        return values
+
+    def _emit(self, value, values):
+        if len(self.stack) == 0:
+            values.append(value)
+            return
+
+        container, key = self.stack[-1]
+        if isinstance(container, list):
+            container.append(value)
+
+        elif key is DONE:
+            self.stack[-1] = (container, value)
+
+        else:
+            container[key] = value
+            self.stack[-1] = (container, DONE)
+
+    def close(self):
+        if self.pending:
+            raise ValueError("Incomplete bencode data")
+
+def biter(data):
+    """
+    Yield the bencode of data as a series of byte chunks
+    """
 
-    cache = ""
     if isinstance(data, dict):
-        cache = cache + "d"
+        yield b"d"
         for key, value in data.items():
-            cache = cache + bencode(key)
-            cache = cache + bencode(value)
+            yield from biter(key)
+            yield from biter(value)
 
-        cache = cache + "e"
-        return cache
+        yield b"e"
 
-    elif isinstance(data, list):
-        cache = cache + "l"
+    elif isinstance(data, (list, tuple)):
+        yield b"l"
         for value in data:
-            cache = cache + bencode(value)
+            yield from biter(value)
 
-        cache = cache + "e"
-        return cache
+        yield b"e"
 
     elif isinstance(data, int):
-        return f"i{data}e"
+        yield b"i%de" % data
 
     else:
-        size = len(data)
-        return f"{size}:{data}"
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        yield b"%d:" % len(data)
+        yield data
+
+def bdump(data, out=None):
+    """
+    Append the bencode of data to out, which is either a bytearray or a stream
+    with a write method, and return out
+    """
+
+    if out is None:
+        out = bytearray()
+
+    write = out.extend if isinstance(out, bytearray) else out.write
+    for chunk in biter(data):
+        write(chunk)
+
+    return out
+
+def bstore(data, view, offset=0):
+    """
+    Write the bencode of data into a fixed size writable buffer starting at
+    offset, returning the offset just past the encoded value, where nothing
+    is written when it does not fit
+    """
+
+    if not isinstance(view, memoryview):
+        view = memoryview(view)
+
+    chunks = list(biter(data))
+    if offset + sum(len(chunk) for chunk in chunks) > len(view):
+        raise ValueError(f"Buffer too small to encode at {offset}")
+
+    for chunk in chunks:
+        stop = offset + len(chunk)
+        view[offset:stop] = chunk
+        offset = stop
+
+    return offset
+
+def bencode(data, enc=False):
+    if enc:
+        data = loads(data)
+
+    return bdump(data).decode("utf-8")
@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
+
+class Executor:
+    """
+    Runs jobs on worker pools, sending pure compute work to processes and
+    running everything else one at a time, in the order it was sent
+    """
+
+    def __init__(self, workers=4, processes=True):
+        self.workers = workers
+        self.use_processes = processes
+
+        self.threads = ThreadPoolExecutor(workers)
+        self.processes = None
+
+        # NOTE - Shared state like Memory is only touched while holding guard,
+        # so a single thread keeps each job's commands in order for free
+        self.guard = Lock()
+        self.worker = ThreadPoolExecutor(1)
+
+    def compute(self, fn, *args):
+        if not self.use_processes:
+            return self.threads.submit(fn, *args)
+
+        if self.processes is None:
+            self.processes = ProcessPoolExecutor(self.workers)
+
+        return self.processes.submit(fn, *args)
+
+    def serial(self, fn, *args):
+        return self.worker.submit(self.guarded, fn, *args)
+
+    def guarded(self, fn, *args):
+        with self.guard:
+            return fn(*args)
+
+    def shutdown(self, wait=True):
+        self.threads.shutdown(wait=wait)
+        self.worker.shutdown(wait=wait)
+        if self.processes is not None:
+            self.processes.shutdown(wait=wait)
+            self.processes = None
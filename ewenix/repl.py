@@ -1,214 +1,443 @@
 from ewenix.util import now, mint
 from ewenix.monad import Nil
-from ewenix.scheduler import Scheduler
-from ewenix.algorithms import Memory
-from ewenix.encoding import bencode, bdecode
+from ewenix.scheduler import Scheduler, TimingWheel
+from ewenix.algorithms import Memory, SlabAllocator
+from ewenix.encoding import bencode, bdecode, bload, bdump
+from ewenix.executor import Executor
+
+from collections import namedtuple, OrderedDict, deque
+from json import loads
+from re import compile as rcompile
+from time import time
+import asyncio
 
 QUIT = "%QUIT%"
 
-class REPL:
-    def __init__(self):
-        self.sched = Scheduler()
-        self.mem = Memory(32*1024)
+Command = namedtuple("Command", [
+    "name",
+    "handler",
+    "about",
+    "args",
+    "jobid",
+    "pure"
+])
+
+COMMANDS = dict()
+
+# Raw spans run from @ to the end of the command so JSON can hold spaces
+TOKEN = rcompile(r'''(?x)
+    @(?P<raw>.*)
+    | "(?P<quoted>[^"]*)"?
+    | (?P<word>[^\s"@]\S*)
+''')
+
+CHAIN = rcompile(r'''(?x)
+    @(?P<raw>[^;]*)
+    | "(?P<quoted>[^"]*)"?
+    | (?P<word>[^\s;"@][^\s;]*)
+    | (?P<sep>;)
+''')
+
+RUN = rcompile(r"\s*run(\s|$)")
+
+class Failure(str):
+    """
+    Result text of a command that did not succeed, which still displays and
+    serializes like any other string
+    """
+
+def fail(error, result):
+    return Failure(result) if error else result
+
+def failed(results):
+    if isinstance(results, Failure):
+        return True
+
+    # Run chains hold the (display, result) of each of their commands
+    if isinstance(results, list):
+        return any(
+            isinstance(step, tuple) and len(step) == 2 and failed(step[1])
+            for step in results
+        )
+
+    return False
+
+# NOTE - Help text is built on first use so later registrations are included
+HELP = None
+
+def command(name, about=None, args=0, jobid=False, pure=False):
+    """
+    Register a handler taking (repl, parts, jobid) for a command, where args
+    is the minimum argument count, jobid asks for a job id to be assigned if
+    missing, and pure marks commands that never touch shared state
+    """
+
+    def wrap(handler):
+        global HELP
+        COMMANDS[name] = Command(name, handler, about, args, jobid, pure)
+        HELP = None
+        return handler
+
+    return wrap
+
+SLOT = rcompile(r"\$([1-9]\d*)")
+
+class Plan:
+    """
+    Parsed commands with their handlers looked up ahead of time, where words
+    like $1 are slots filled in from the parameters on every call
+    """
+
+    def __init__(self, commands, chain=False):
+        self.chain = chain
+        self.steps = list()
+        for parts in commands:
+            if len(parts) == 0:
+                continue
 
-    def encode(self, data, enc=False):
-        return bencode(data, enc=enc)
+            slots = list()
+            for i, word in enumerate(parts):
+                match = SLOT.fullmatch(word)
+                if match is not None:
+                    slots.append((i, int(match.group(1)) - 1))
 
-    def decode(self, data):
-        return bdecode(data)
+            self.steps.append((COMMANDS.get(parts[0]), parts, slots))
 
-    def read(self):
-        return input("ewenix> ")
+    def bind(self, parts, slots, params):
+        if len(slots) == 0:
+            return parts
 
-    def eval(self, data, jobid=None):
-        commands = dict()
-        commands["help"] = "Display this message"
-        commands["print"] = "Print back input"
-        commands["echo"] = "Print back input with a delay"
-        commands["alloc"] = "Allocate blocks of memory"
-        commands["free"] = "Free blocks of memory"
-        commands["write"] = "Write to blocks of memory"
-        commands["read"] = "Read from blocks of memory"
-        commands["bwrite"] = "Write bencode to blocks of memory"
-        commands["bread"] = "Read bencode from blocks of memory"
-        commands["quit"] = "Exit the REPL"
-
-        parts = list()
-        cache = ""
-        mode = 0
-        for i in range(len(data)):
-            char = data[i]
-            if char == "@":
-                mode = 3
-                continue
+        parts = list(parts)
+        for i, index in slots:
+            # NOTE - Slots without a parameter are left as written
+            if index < len(params):
+                parts[i] = str(params[index])
 
-            if char == "\"":
-                if mode == 0:
-                    mode = 2
-                    continue
+        return parts
 
-                elif mode == 1:
-                    if len(cache) > 0:
-                        parts.append(cache)
+    def __call__(self, repl, params=(), jobid=None):
+        if not self.chain:
+            # NOTE - A blank line does nothing, just as it does through call
+            if len(self.steps) == 0:
+                return False, None
 
-                    cache = ""
-                    mode = 0
-                    continue
+            spec, parts, slots = self.steps[0]
+            return repl.call_spec(spec, self.bind(parts, slots, params), jobid)
 
-            elif char == " " and mode not in [1,3]:
-                if len(cache) > 0:
-                    parts.append(cache)
+        if jobid is None:
+            jobid = repl.sched.get_next_id()
 
-                cache = ""
-                mode = 0
-                continue
+        results = list()
+        for spec, parts, slots in self.steps:
+            parts = self.bind(parts, slots, params)
+            results.append(repl.call_spec(spec, parts, jobid))
 
-            elif char == ";" and mode == 3:
-                cache = cache + char
-                if len(cache) > 0:
-                    parts.append(cache)
+        return True, results
 
-                cache = ""
-                mode = 0
-                continue
+class PlanCache:
+    def __init__(self, size=128):
+        self.size = size
+        self.clear()
 
-            cache = cache + char
-            continue
+    def clear(self):
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-        parts.append(cache)
+    def get(self, text, build):
+        plan = self.plans.get(text)
+        if plan is not None:
+            self.plans.move_to_end(text)
+            self.hits = self.hits + 1
+            return plan
 
-        if parts[0] == "help":
-            dialog = "\n".join(f"{k} - {v}" for k, v in commands.items())
-            return True, dialog
+        self.misses = self.misses + 1
+        plan = build(text)
+        self.plans[text] = plan
+        if len(self.plans) > self.size:
+            self.plans.popitem(last=False)
 
-        elif parts[0] == "print":
-            return True, " ".join(parts[1:])
+        return plan
 
-        elif parts[0] == "echo":
-            suspend = now() + mint(parts[1], 0)
-            content = " ".join(parts[2:])
-            jobid = self.sched.push(f"print {content}", suspend)
-            return True, f"Queued: {jobid} until {suspend}"
+    def stats(self):
+        stats = dict()
+        stats["size"] = len(self.plans)
+        stats["hits"] = self.hits
+        stats["misses"] = self.misses
+        return stats
 
-        elif parts[0] == "alloc":
-            if jobid is None:
-                jobid = self.sched.get_next_id()
+WORKER = None
 
-            error, result = self.mem.alloc(mint(parts[1], 0), jobid=jobid)
-            return True, result
+def evaluate(data):
+    """
+    Evaluate a pure compute command inside of a worker process
+    """
 
-        elif parts[0] == "free":
-            if jobid is None:
-                jobid = self.sched.get_next_id()
+    global WORKER
+    if WORKER is None:
+        WORKER = REPL()
 
-            error, result = self.mem.free(mint(parts[1], 0), jobid=jobid)
-            return True, result
+    return WORKER.eval(data)
 
-        elif parts[0] == "write":
-            if jobid is None:
-                jobid = self.sched.get_next_id()
+class REPL:
+    def __init__(self, wheel=False, sched=None, mem=None, workers=0,
+            processes=True):
+        # NOTE - Sessions passed the same scheduler and memory share them
+        if sched is None:
+            sched = TimingWheel() if wheel else Scheduler()
 
-            error, result = self.mem.write(
-                mint(parts[1], 0),
-                [int(p) for p in parts[2:]],
-                jobid=jobid
-            )
-            return True, result
+        if mem is None:
+            mem = Memory(32*1024)
 
-        elif parts[0] == "read":
-            if jobid is None:
-                jobid = self.sched.get_next_id()
+        self.sched = sched
+        self.mem = mem
 
-            error, result = self.mem.read(
-                mint(parts[1], 0),
-                mint(parts[2], 0),
-                jobid=jobid
-            )
-            return True, result
+        # NOTE - Memory commands go through the slab layer and count bytes
+        self.slab = SlabAllocator(mem)
+        self.wakeup = None
+        self.plans = PlanCache()
 
-        elif parts[0] == "bwrite":
-            if jobid is None:
-                jobid = self.sched.get_next_id()
+        self.executor = None
+        self.pending = deque()
+        if workers > 0:
+            self.executor = Executor(workers, processes)
 
-            error, result = self.mem.write(
-                mint(parts[1], 0),
-                [ord(p) for p in bencode(parts[2], True)],
-                jobid=jobid
-            )
-            return True, result
+    def encode(self, data, enc=False):
+        return bencode(data, enc=enc)
+
+    def decode(self, data):
+        return bdecode(data)
+
+    def read(self):
+        return input("ewenix> ")
 
-        elif parts[0] == "bread":
-            if jobid is None:
-                jobid = self.sched.get_next_id()
+    def parse(self, data):
+        """
+        Split a line into its parts, where a run chain becomes a list of the
+        parts for each of its commands
+        """
 
-            error, result = self.mem.read(
-                mint(parts[1], 0),
-                mint(parts[2], 0),
-                jobid=jobid
-            )
-            value = "".join(chr(r) for r in result)
-            _, final = bdecode(value)
-            return True, final
+        # NOTE - Only run treats semicolons as separators
+        chain = RUN.match(data) is not None
+        pattern = CHAIN if chain else TOKEN
 
-        elif parts[0] == "run":
-            if jobid is None:
-                jobid = self.sched.get_next_id()
+        words = list()
+        commands = [words]
+        for match in pattern.finditer(data):
+            kind = match.lastgroup
+            if kind == "sep":
+                words = list()
+                commands.append(words)
 
-            index = 1
-            results = list()
-            command = list()
-            while index < len(parts):
-                part = parts[index]
-                #print(part, index)
-                index = index + 1
+            elif kind == "raw":
+                words.append(match.group("raw").rstrip())
 
-                if "\"" in part[1:-1]:
-                    part = f"@{part}"
+            else:
+                words.append(match.group(kind))
+
+        if not chain:
+            return words
 
-                run = False
-                if part == ";":
-                    run = True
+        commands[0] = commands[0][1:]
+        return ["run"] + [words for words in commands if len(words) > 0]
 
-                elif part.endswith(";"):
-                    command.append(part[:-1])
-                    run = True
+    def compile(self, data):
+        """
+        Plan for a line, reused from the cache when the same text comes again
+        """
 
-                elif index == len(parts):
-                    command.append(part)
-                    run = True
+        return self.plans.get(data, self.build)
 
-                if not run:
-                    command.append(part)
-                    continue
+    def build(self, data):
+        parts = self.parse(data)
+        if len(parts) > 1 and parts[0] == "run" and isinstance(parts[1], list):
+            return Plan(parts[1:], chain=True)
 
-                cmd = " ".join(command)
-                cmd = cmd.strip()
-                command = list()
+        return Plan([parts])
 
-                display, result = self.eval(cmd, jobid=jobid)
-                results.append((display, result))
+    def eval(self, data, jobid=None, params=()):
+        if RUN.match(data) is not None:
+            return self.compile(data)(self, params, jobid)
 
-            return True, results
+        return self.call(self.parse(data), jobid=jobid)
+
+    def call(self, parts, jobid=None):
+        if len(parts) == 0:
+            return False, None
+
+        return self.call_spec(COMMANDS.get(parts[0]), parts, jobid)
+
+    def call_spec(self, spec, parts, jobid=None):
+        if spec is None:
+            return False, None
 
-        elif parts[0] == "quit":
-            return False, QUIT
+        if len(parts) - 1 < spec.args:
+            return True, Failure(f"{spec.name} expects at least {spec.args} argument(s)")
 
-        return False, None
+        if spec.jobid and jobid is None:
+            jobid = self.sched.get_next_id()
+
+        return spec.handler(self, parts, jobid)
+
+    @command("help", "Display this message", pure=True)
+    def cmd_help(self, parts, jobid):
+        global HELP
+        if HELP is None:
+            HELP = "\n".join(
+                f"{spec.name} - {spec.about}"
+                for spec in COMMANDS.values()
+                if spec.about is not None
+            )
+
+        return True, HELP
+
+    @command("print", "Print back input", pure=True)
+    def cmd_print(self, parts, jobid):
+        return True, " ".join(parts[1:])
+
+    @command("echo", "Print back input with a delay", args=1)
+    def cmd_echo(self, parts, jobid):
+        suspend = now() + mint(parts[1], 0)
+        content = " ".join(parts[2:])
+        jobid = self.sched.push(f"print {content}", suspend)
+        return True, f"Queued: {jobid} until {suspend}"
+
+    @command("alloc", "Allocate bytes of memory", args=1, jobid=True)
+    def cmd_alloc(self, parts, jobid):
+        if len(parts) > 2:
+            sizes = [mint(p, 0) for p in parts[1:]]
+            error, result = self.slab.alloc_many(sizes, jobid=jobid)
+            return True, fail(error, result)
+
+        error, result = self.slab.alloc(mint(parts[1], 0), jobid=jobid)
+        return True, fail(error, result)
+
+    @command("free", "Free allocated memory", args=1, jobid=True)
+    def cmd_free(self, parts, jobid):
+        if len(parts) > 2:
+            addresses = [mint(p, 0) for p in parts[1:]]
+            error, result = self.slab.free_many(addresses, jobid=jobid)
+            return True, fail(error, result)
+
+        error, result = self.slab.free(mint(parts[1], 0), jobid=jobid)
+        return True, fail(error, result)
+
+    @command("write", "Write to blocks of memory", args=2, jobid=True)
+    def cmd_write(self, parts, jobid):
+        error, result = self.slab.write(
+            mint(parts[1], 0),
+            [int(p) for p in parts[2:]],
+            jobid=jobid
+        )
+        return True, fail(error, result)
+
+    @command("read", "Read from blocks of memory", args=2, jobid=True)
+    def cmd_read(self, parts, jobid):
+        error, result = self.slab.read(
+            mint(parts[1], 0),
+            mint(parts[2], 0),
+            jobid=jobid
+        )
+        return True, fail(error, result)
+
+    @command("bwrite", "Write bencode to blocks of memory", args=2, jobid=True)
+    def cmd_bwrite(self, parts, jobid):
+        try:
+            data = bdump(loads(parts[2]))
+
+        except ValueError as error:
+            return True, Failure(f"Invalid JSON: {error}")
+
+        error, result = self.slab.write(
+            mint(parts[1], 0),
+            data,
+            jobid=jobid
+        )
+        return True, fail(error, result)
+
+    @command("bread", "Read bencode from blocks of memory", args=2, jobid=True)
+    def cmd_bread(self, parts, jobid):
+        error, result = self.slab.read(
+            mint(parts[1], 0),
+            mint(parts[2], 0),
+            jobid=jobid,
+            view=True
+        )
+        if error:
+            return True, Failure(result)
+
+        try:
+            _, final = bload(result)
+
+        except ValueError as error:
+            return True, Failure(f"Invalid bencode: {error}")
+
+        return True, final
+
+    @command("encode", "Encode JSON as bencode", args=1, pure=True)
+    def cmd_encode(self, parts, jobid):
+        try:
+            return True, bencode(parts[1], True)
+
+        except ValueError as error:
+            return True, Failure(f"Invalid JSON: {error}")
+
+    @command("decode", "Decode bencode", args=1, pure=True)
+    def cmd_decode(self, parts, jobid):
+        try:
+            decoded = bdecode(" ".join(parts[1:]))
+
+        except ValueError as error:
+            return True, Failure(f"Invalid bencode: {error}")
+
+        if decoded is None:
+            return True, Failure("Nothing to decode")
+
+        _, final = decoded
+        return True, final
+
+    @command("run", args=1, jobid=True)
+    def cmd_run(self, parts, jobid):
+        commands = parts[1:]
+        if isinstance(commands[0], str):
+            commands = [commands]
+
+        results = list()
+        for command in commands:
+            results.append(self.call(command, jobid=jobid))
+
+        return True, results
+
+    @command("quit", "Exit the REPL", pure=True)
+    def cmd_quit(self, parts, jobid):
+        return False, QUIT
+
+    def show(self, results):
+        if not isinstance(results, list):
+            results = [results]
+
+        for result in results:
+            print(result)
+
+        print()
 
     def execute(self, data, sim=True, jobid=None):
-        display, results = self.eval(data, jobid=jobid)
+        if self.executor is not None:
+            with self.executor.guard:
+                display, results = self.eval(data, jobid=jobid)
+
+        else:
+            display, results = self.eval(data, jobid=jobid)
+
+        return self.outcome(display, results, sim)
+
+    def outcome(self, display, results, sim=True):
         if display:
             if sim:
                 return False, results
 
             else:
-                if not isinstance(results, list):
-                    results = [results]
-
-                for result in results:
-                    print(result)
-
-                print()
+                self.show(results)
 
         elif results == QUIT:
             if sim:
@@ -221,24 +450,136 @@ class REPL:
 
         return False
 
-    def process(self, sim=True):
-        ts = now()
+    def release(self, jobid):
+        """
+        Free all memory still owned by a job that has gone away
+        """
+
+        if self.executor is not None:
+            with self.executor.guard:
+                return self.slab.release_job(jobid)
+
+        return self.slab.release_job(jobid)
+
+    def execute_stream(self, lines, jobid=None, errors="stop"):
+        """
+        Yield the (done, result) of every line as execute would in sim mode,
+        sharing one job id across the lines, where errors is stop or continue
+        for lines that raise or whose command fails
+        """
+
+        if errors not in ("stop", "continue"):
+            raise ValueError(f"Unknown error handling: {errors}")
+
+        if jobid is None:
+            jobid = self.sched.get_next_id()
+
+        guard = self.executor.guard if self.executor is not None else None
+        for line in lines:
+            try:
+                # NOTE - eval only caches plans for run chains, like execute
+                if guard is None:
+                    display, results = self.eval(line, jobid=jobid)
+
+                else:
+                    with guard:
+                        display, results = self.eval(line, jobid=jobid)
 
-        mentry = self.sched.pop()
-        if not isinstance(mentry, Nil):
-            entry = mentry.value
-            until = entry["until"]
-            action = entry["action"]
-            jobid = entry["id"]
-            if not sim and until > ts:
-                self.sched.push(action, until, jobid)
+            except Exception as e:
+                yield False, e
+                if errors == "stop":
+                    return
+
+                continue
+
+            if display:
+                yield False, results
+                if errors == "stop" and failed(results):
+                    return
+
+            elif results == QUIT:
+                yield True, None
+                return
 
             else:
-                result = self.execute(action, sim)
-                if sim:
-                    return result
+                yield False, None
+
+    def execute_many(self, lines, jobid=None, errors="stop"):
+        return list(self.execute_stream(lines, jobid=jobid, errors=errors))
+
+    def submit(self, entry):
+        action = entry["action"]
+        spec = COMMANDS.get(action.split(" ", 1)[0])
+        if spec is not None and spec.pure:
+            return self.executor.compute(evaluate, action)
+
+        # NOTE - Memory ownership relies on each job's commands running in order
+        return self.executor.serial(self.eval, action, entry["id"])
+
+    def dispatch(self, sim=True):
+        ts = now()
+
+        entries = list()
+        with self.executor.guard:
+            while True:
+                mentry = self.sched.peek()
+                if isinstance(mentry, Nil):
+                    break
+
+                if not sim and mentry.value["until"] > ts:
+                    break
+
+                entries.append(self.sched.pop().value)
+
+        return [self.submit(entry) for entry in entries]
 
-                return True
+    def result(self, future):
+        try:
+            return future.result()
+
+        except Exception as error:
+            return True, f"{type(error).__name__}: {error}"
+
+    def process_pool(self, sim=True):
+        if sim:
+            # NOTE - One job per call so the result has the same shape as process
+            with self.executor.guard:
+                mentry = self.sched.pop()
+
+            if isinstance(mentry, Nil):
+                return False, None
+
+            display, results = self.result(self.submit(mentry.value))
+            return self.outcome(display, results, sim)
+
+        self.pending.extend(self.dispatch(sim))
+
+        # NOTE - Results are shown in the order jobs were due, so a finished
+        # job waits behind any earlier one that is still running
+        ran = False
+        while len(self.pending) > 0 and self.pending[0].done():
+            future = self.pending.popleft()
+            display, results = self.result(future)
+            self.outcome(display, results, sim)
+            ran = True
+
+        return ran
+
+    def process(self, sim=True):
+        if self.executor is not None:
+            return self.process_pool(sim)
+
+        ts = now()
+
+        # NOTE - Peek first so jobs that are not due yet stay where they are
+        mentry = self.sched.peek()
+        if not isinstance(mentry, Nil) and (sim or mentry.value["until"] <= ts):
+            entry = self.sched.pop().value
+            result = self.execute(entry["action"], sim, entry["id"])
+            if sim:
+                return result
+
+            return True
 
         if sim:
             return False, None
@@ -259,3 +600,70 @@ class REPL:
 
     def start(self):
         self.loop()
+
+    async def aread(self):
+        return await asyncio.to_thread(self.read)
+
+    def wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def arun(self, wakeup):
+        """
+        Run scheduled jobs as they come due, sleeping until the next one
+        """
+
+        while True:
+            wakeup.clear()
+
+            mentry = self.sched.peek()
+            if isinstance(mentry, Nil):
+                await wakeup.wait()
+                continue
+
+            delay = mentry.value["until"] - time()
+            if delay > 0:
+                loop = asyncio.get_running_loop()
+                timer = loop.call_later(delay, wakeup.set)
+                try:
+                    await wakeup.wait()
+
+                finally:
+                    timer.cancel()
+
+                continue
+
+            entry = self.sched.pop().value
+            self.execute(entry["action"], False, entry["id"])
+
+            # Let input and other sessions in between jobs
+            await asyncio.sleep(0)
+
+    async def aloop(self):
+        self.wakeup = asyncio.Event()
+        runner = asyncio.create_task(self.arun(self.wakeup))
+        try:
+            while True:
+                try:
+                    data = await self.aread()
+
+                except EOFError:
+                    break
+
+                done = self.execute(data, False)
+                self.wake()
+                if done:
+                    break
+
+        finally:
+            runner.cancel()
+            self.wakeup = None
+
+            try:
+                await runner
+
+            except asyncio.CancelledError:
+                pass
+
+    def astart(self):
+        asyncio.run(self.aloop())
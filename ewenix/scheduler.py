@@ -1,8 +1,8 @@
 from ewenix.monad import Just, Nil
 from ewenix.util import now
 
-from collections import defaultdict
-from heapq import heappush, heappop, heapify
+from heapq import heappush, heappop
+from itertools import count
 
 class Scheduler:
     def __init__(self):
@@ -11,7 +11,11 @@ class Scheduler:
     def clear(self):
         self.jobid = 1
         self.queue = list()
-        self.jobs = defaultdict(dict)
+        self.counter = count()
+
+        # Pending jobs by id, anything in the heap but not here is cancelled
+        self.index = dict()
+        self.size = 0
 
     def get_next_id(self):
         jobid = self.jobid + 1
@@ -26,28 +30,358 @@ class Scheduler:
         if jobid is None:
             jobid = self.get_next_id()
 
-        jobs = self.jobs[suspend]
-        if jobs.get(jobid) is None:
-            entry = dict()
-            entry["ts"] = ts
-            entry["action"] = action
-            self.jobs[suspend][jobid] = entry
+        entry = dict()
+        entry["ts"] = ts
+        entry["action"] = action
 
-        heappush(self.queue, suspend)
+        self.insert(entry, suspend, jobid)
         return jobid
 
+    def insert(self, entry, suspend, jobid):
+        # NOTE - Counter keeps jobs sharing a timestamp and id in FIFO order
+        seq = next(self.counter)
+        job = suspend, jobid, seq, entry
+        heappush(self.queue, job)
+        self.index.setdefault(jobid, dict())[seq] = job
+        self.size = self.size + 1
+
+    def prune(self):
+        while len(self.queue) > 0:
+            suspend, jobid, seq, entry = self.queue[0]
+            jobs = self.index.get(jobid)
+            if jobs is not None and seq in jobs:
+                return self.queue[0]
+
+            heappop(self.queue)
+
+        return None
+
+    def peek(self):
+        job = self.prune()
+        if job is None:
+            return Nil()
+
+        suspend, jobid, _, entry = job
+        entry["until"] = suspend
+        entry["id"] = jobid
+        return Just(entry)
+
     def pop(self):
-        if len(self.queue) == 0:
+        job = self.prune()
+        if job is None:
             return Nil()
 
-        suspend = heappop(self.queue)
-        jobs = self.jobs.get(suspend)
-        keys = sorted(jobs.keys())
-        jobid = keys[0]
-        entry = jobs.pop(jobid)
+        heappop(self.queue)
+        suspend, jobid, seq, entry = job
+        jobs = self.index[jobid]
+        jobs.pop(seq)
+        if len(jobs) == 0:
+            del self.index[jobid]
+
+        self.size = self.size - 1
+        entry["until"] = suspend
+        entry["id"] = jobid
+        return Just(entry)
+
+    def cancel(self, jobid):
+        jobs = self.index.pop(jobid, None)
+        if jobs is None:
+            return False
+
+        self.size = self.size - len(jobs)
+        return True
+
+    def reschedule(self, jobid, suspend):
+        jobs = self.index.pop(jobid, None)
+        if jobs is None:
+            return False
+
+        self.size = self.size - len(jobs)
+        for _, _, _, entry in jobs.values():
+            self.insert(entry, suspend, jobid)
+
+        return True
+
+    def __len__(self):
+        return self.size
+
+class TimingWheel:
+    """
+    Hashed hierarchical timing wheel with the same interface as Scheduler,
+    where each level has 64 slots and each slot spans 64 slots of the level
+    below it
+    """
+
+    def __init__(self, levels=4, bits=6):
+        self.levels = levels
+        self.bits = bits
+        self.slots = 1 << bits
+        self.mask = self.slots - 1
+
+        self.clear()
+
+    def clear(self):
+        self.jobid = 1
+        self.tick = now()
+        self.counter = count()
+
+        self.wheels = list()
+        for level in range(self.levels):
+            self.wheels.append([dict() for _ in range(self.slots)])
+
+        self.counts = [0] * self.levels
+        self.overflow = dict()
+        self.ready = list()
+        self.stale = 0
+        self.index = dict()
+        self.size = 0
+
+    def get_next_id(self):
+        jobid = self.jobid + 1
+        self.jobid = jobid
+        return jobid
+
+    def __len__(self):
+        return self.size
+
+    def place(self, job):
+        suspend, jobid, seq, entry = job
+        if suspend <= self.tick:
+            heappush(self.ready, job)
+            self.index[jobid][seq] = None, None, job
+            return
+
+        # Lowest level where the job shares every higher slot with the tick
+        level = 0
+        while level < self.levels:
+            shift = self.bits * (level + 1)
+            if suspend >> shift == self.tick >> shift:
+                break
+
+            level = level + 1
+
+        if level == self.levels:
+            self.overflow[seq] = job
+            self.index[jobid][seq] = level, None, job
+            return
+
+        slot = (suspend >> (self.bits * level)) & self.mask
+        self.wheels[level][slot][seq] = job
+        self.counts[level] = self.counts[level] + 1
+        self.index[jobid][seq] = level, slot, job
+
+    def push(self, action, suspend=None, jobid=None):
+        ts = now()
+        if suspend is None:
+            suspend = ts
+
+        if jobid is None:
+            jobid = self.get_next_id()
+
+        entry = dict()
+        entry["ts"] = ts
+        entry["action"] = action
+
+        self.insert(entry, suspend, jobid)
+        return jobid
+
+    def insert(self, entry, suspend, jobid):
+        self.index.setdefault(jobid, dict())
+        self.place((suspend, jobid, next(self.counter), entry))
+        self.size = self.size + 1
+
+    def remove(self, jobid):
+        jobs = self.index.pop(jobid, None)
+        if jobs is None:
+            return None
+
+        for seq, (level, slot, job) in jobs.items():
+            if level is None:
+                # NOTE - Already due, so it is skipped when it reaches the top
+                self.stale = self.stale + 1
+                continue
+
+            self.detach(seq, level, slot)
+
+        self.size = self.size - len(jobs)
+        return [job for _, _, job in jobs.values()]
+
+    def detach(self, seq, level, slot):
+        if level == self.levels:
+            return self.overflow.pop(seq)
+
+        self.counts[level] = self.counts[level] - 1
+        return self.wheels[level][slot].pop(seq)
+
+    def cancel(self, jobid):
+        return self.remove(jobid) is not None
+
+    def reschedule(self, jobid, suspend):
+        jobs = self.remove(jobid)
+        if jobs is None:
+            return False
+
+        for _, _, _, entry in jobs:
+            self.insert(entry, suspend, jobid)
+
+        return True
+
+    def cascade(self, tick):
+        for level in range(1, self.levels + 1):
+            if tick & ((1 << (self.bits * level)) - 1) != 0:
+                break
+
+            if level == self.levels:
+                jobs = self.overflow
+                self.overflow = dict()
+
+            else:
+                slot = (tick >> (self.bits * level)) & self.mask
+                jobs = self.wheels[level][slot]
+                self.wheels[level][slot] = dict()
+                self.counts[level] = self.counts[level] - len(jobs)
+
+            for job in jobs.values():
+                self.place(job)
+
+    def step(self, target):
+        """
+        Move the tick to the next point before target where jobs expire or
+        cascade down a level
+        """
+
+        level = 0
+        while level < self.levels and self.counts[level] == 0:
+            level = level + 1
+
+        if level == 0:
+            tick = self.tick + 1
+            boundary = min((self.tick | self.mask) + 1, target)
+            while tick < boundary:
+                if len(self.wheels[0][tick & self.mask]) > 0:
+                    break
+
+                tick = tick + 1
+
+        else:
+            shift = self.bits * min(level, self.levels)
+            tick = min(((self.tick >> shift) + 1) << shift, target)
+
+        self.tick = tick
+        self.cascade(tick)
+
+        jobs = self.wheels[0][tick & self.mask]
+        if len(jobs) > 0:
+            self.wheels[0][tick & self.mask] = dict()
+            self.counts[0] = self.counts[0] - len(jobs)
+            for job in jobs.values():
+                self.place(job)
+
+    def advance(self, target):
+        """
+        Expire jobs up to target
+        """
+
+        while len(self.ready) - self.stale < self.size and self.tick < target:
+            self.step(target)
+
+    def earliest(self):
+        """
+        Earliest job still waiting in the wheels, found without moving the tick
+        """
+
+        # NOTE - Every job on a level is due before any job on the levels above
+        for level in range(self.levels):
+            if self.counts[level] == 0:
+                continue
+
+            start = (self.tick >> (self.bits * level)) & self.mask
+            for slot in range(start, self.slots):
+                jobs = self.wheels[level][slot]
+                if len(jobs) > 0:
+                    return min(jobs.values())
+
+        if len(self.overflow) > 0:
+            return min(self.overflow.values())
+
+        return None
+
+    def prune(self):
+        while len(self.ready) > 0:
+            suspend, jobid, seq, entry = self.ready[0]
+            jobs = self.index.get(jobid)
+            if jobs is not None and seq in jobs:
+                return self.ready[0]
+
+            heappop(self.ready)
+            self.stale = self.stale - 1
+
+        return None
+
+    def take(self):
+        if self.prune() is None:
+            return None
+
+        suspend, jobid, seq, entry = heappop(self.ready)
+
+        jobs = self.index[jobid]
+        jobs.pop(seq)
         if len(jobs) == 0:
-            del self.jobs[suspend]
+            del self.index[jobid]
+
+        self.size = self.size - 1
+        entry["until"] = suspend
+        entry["id"] = jobid
+        return entry
+
+    def peek(self):
+        self.advance(now())
+
+        job = self.prune()
+        if job is None:
+            job = self.earliest()
 
+        if job is None:
+            return Nil()
+
+        suspend, jobid, _, entry = job
         entry["until"] = suspend
         entry["id"] = jobid
         return Just(entry)
+
+    def pop(self):
+        self.advance(now())
+
+        if self.prune() is None:
+            job = self.earliest()
+            if job is None:
+                return Nil()
+
+            # Hand the job over to ready without moving the tick up to it
+            suspend, jobid, seq, entry = job
+            level, slot, _ = self.index[jobid][seq]
+            self.detach(seq, level, slot)
+            heappush(self.ready, job)
+            self.index[jobid][seq] = None, None, job
+
+        return Just(self.take())
+
+    def expire(self, ts=None):
+        """
+        Remove and return every job due by ts in order
+        """
+
+        if ts is None:
+            ts = now()
+
+        self.advance(ts)
+
+        entries = list()
+        while True:
+            job = self.prune()
+            if job is None or job[0] > ts:
+                break
+
+            entries.append(self.take())
+
+        return entries
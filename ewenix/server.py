@@ -0,0 +1,134 @@
+from ewenix.repl import REPL
+
+from json import dumps
+from time import perf_counter
+import asyncio
+
+STATS = "%STATS%"
+LIMIT = 1 << 16
+
+class Connection:
+    def __init__(self, jobid):
+        self.jobid = jobid
+
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+
+    def record(self, elapsed):
+        self.count = self.count + 1
+        self.total = self.total + elapsed
+        self.slowest = max(self.slowest, elapsed)
+
+    def stats(self):
+        stats = dict()
+        stats["jobid"] = self.jobid
+        stats["count"] = self.count
+        stats["total"] = self.total
+        stats["mean"] = self.total / self.count if self.count else 0.0
+        stats["max"] = self.slowest
+        return stats
+
+class Server:
+    """
+    Line based TCP front-end to a shared REPL, where every line is a command
+    and every command gets back one line of JSON holding [done, result]
+    """
+
+    def __init__(self, repl=None, host="127.0.0.1", port=0):
+        self.repl = repl if repl is not None else REPL()
+        self.host = host
+        self.port = port
+
+        self.server = None
+        self.runner = None
+        self.connections = dict()
+
+    def reply(self, done, result):
+        return (dumps([done, result], default=str) + "\n").encode()
+
+    def handle(self, conn, line):
+        if line == STATS:
+            return False, self.reply(False, conn.stats())
+
+        timer = perf_counter()
+        try:
+            done, result = self.repl.execute(line, sim=True, jobid=conn.jobid)
+
+        except Exception as error:
+            # NOTE - One bad command must not cost the rest of the batch
+            done, result = False, f"{type(error).__name__}: {error}"
+
+        conn.record(perf_counter() - timer)
+        return done, self.reply(done, result)
+
+    async def serve(self, reader, writer):
+        conn = Connection(self.repl.sched.get_next_id())
+        self.connections[conn.jobid] = conn
+
+        try:
+            done = False
+            cache = b""
+            while not done:
+                chunk = await reader.read(1 << 16)
+                if len(chunk) == 0:
+                    break
+
+                # Answer every complete command sent so far in one write
+                *lines, cache = (cache + chunk).split(b"\n")
+                replies = list()
+                for line in lines:
+                    command = line.decode(errors="replace").strip()
+                    if len(command) == 0:
+                        continue
+
+                    done, reply = self.handle(conn, command)
+                    replies.append(reply)
+                    if done:
+                        break
+
+                # NOTE - A line that never ends cannot be answered, so give up
+                if not done and len(cache) > LIMIT:
+                    replies.append(self.reply(False, "Line is too long"))
+                    done = True
+
+                self.repl.wake()
+                if len(replies) > 0:
+                    writer.write(b"".join(replies))
+                    await writer.drain()
+
+        finally:
+            self.connections.pop(conn.jobid, None)
+            self.repl.release(conn.jobid)
+            writer.close()
+
+    def stats(self):
+        return [conn.stats() for conn in self.connections.values()]
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+        # Scheduled jobs such as echo still run on the shared REPL
+        self.repl.wakeup = asyncio.Event()
+        self.runner = asyncio.create_task(self.repl.arun(self.repl.wakeup))
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+        self.runner.cancel()
+        try:
+            await self.runner
+
+        except asyncio.CancelledError:
+            pass
+
+        self.repl.wakeup = None
+
+    async def forever(self):
+        await self.start()
+        print(f"Listening on {self.host}:{self.port}")
+        async with self.server:
+            await self.server.serve_forever()
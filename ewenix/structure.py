@@ -1,5 +1,7 @@
 from heapq import heappush, heappop, heapify
 from struct import pack, unpack
+from math import ceil
+from re import compile as rcompile
 from time import time
 
 MINIMUM = float("-inf")
@@ -17,7 +19,7 @@ class MinHeap:
         self.heap = list()
 
     def parent(self, index):
-        return (i-1)/2
+        return (index-1) // 2
 
     def push(self, key):
         heappush(self.heap, key)
@@ -28,13 +30,14 @@ class MinHeap:
         """
 
         self.heap[index] = new_value
-        while i != 0 and self.heap[self.parent(index)] > self.heap[index]:
+        while index != 0 and self.heap[self.parent(index)] > self.heap[index]:
             # Swap index with parent of index
-            parent = self.parent[index]
+            parent = self.parent(index)
             self.heap[index], self.heap[parent] = (
                 self.heap[parent],
                 self.heap[index]
             )
+            index = parent
 
     def pop(self):
         return heappop(self.heap)
@@ -46,6 +49,111 @@ class MinHeap:
     def get(self):
         return self.heap[0]
 
+class Bitmap:
+    """
+    View of a region of a byte buffer as a bitmap, where bit 0 is the most
+    significant bit of the first byte in the region
+    """
+
+    def __init__(self, buffer, offset=0, size=None):
+        self.buffer = buffer
+        self.offset = offset
+
+        if size is None:
+            size = (len(buffer) - offset) * 8
+
+        self.size = size
+        self.length = ceil(size / 8)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        byte = self.buffer[self.offset + index // 8]
+        return (byte >> (7 - index % 8)) & 1 == 1
+
+    def _apply(self, k, mask, value):
+        if value:
+            self.buffer[k] = self.buffer[k] | mask
+
+        else:
+            self.buffer[k] = self.buffer[k] & (~mask & 0xff)
+
+    def set(self, start, count, value=True):
+        if start < 0 or start + count > self.size:
+            raise IndexError(f"Bits {start}+{count} outside of {self.size}")
+
+        if count <= 0:
+            return
+
+        stop = start + count - 1
+        first = self.offset + start // 8
+        last = self.offset + stop // 8
+        head = 0xff >> (start % 8)
+        tail = (0xff << (7 - stop % 8)) & 0xff
+
+        if first == last:
+            self._apply(first, head & tail, value)
+            return
+
+        self._apply(first, head, value)
+        if last - first > 1:
+            fill = b"\xff" if value else b"\x00"
+            self.buffer[first+1:last] = fill * (last - first - 1)
+
+        self._apply(last, tail, value)
+
+    def clear(self, start, count):
+        self.set(start, count, False)
+
+    def value(self):
+        """
+        Bitmap as an integer where bit 0 is the most significant bit
+        """
+
+        raw = bytes(self.buffer[self.offset:self.offset+self.length])
+        return int.from_bytes(raw, "big") >> (self.length * 8 - self.size)
+
+    def count(self, value=True):
+        ones = self.value().bit_count()
+        return ones if value else self.size - ones
+
+    def find(self, count, value=False):
+        """
+        Index of the first run of count bits matching value, otherwise None
+        """
+
+        if count <= 0 or count > self.size:
+            return None
+
+        bits = self.value()
+        if not value:
+            bits = ~bits & ((1 << self.size) - 1)
+
+        # Fold runs together so a set bit marks the start of a long enough run
+        have = 1
+        while have < count and bits != 0:
+            step = min(have, count - have)
+            bits = bits & (bits << step)
+            have = have + step
+
+        if bits == 0:
+            return None
+
+        return self.size - bits.bit_length()
+
+    def runs(self, value=False):
+        """
+        Yield (start, count) for each maximal run of bits matching value
+        """
+
+        tape = format(self.value(), f"0{self.size}b") if self.size else ""
+        pattern = BRUNS[1 if value else 0]
+        for match in pattern.finditer(tape):
+            yield match.start(), match.end() - match.start()
+
+BRUNS = rcompile("0+"), rcompile("1+")
+
 class Encoder:
     def __init__(self, codes=["I"]):
         self.codes = codes
@@ -66,6 +174,7 @@ class Encoder:
 class FileEntry():
     def __init__(self, name, index, offset, size, isdir=False):
         self.sector = None
+        self.slot = None
 
         self.etype = 1 if isdir else 0
         self.attrs = 0
@@ -74,7 +183,7 @@ class FileEntry():
         self.index = index
         self.offset = offset
 
-        if len(size) > pow(2, 16):
+        if size >= pow(2, 16):
             raise ValueError("Size is too large")
 
         self.size = size
@@ -84,26 +193,25 @@ class FileEntry():
 
         self.name = name
 
-    @staticmethod
+    @classmethod
     def init(cls, raw, obj=None):
         tape = list()
-        for byte in raw:
-            bits = self._encode(byte)
-            tape = tape + bits
+        for byte in raw[:14]:
+            tape = tape + cls._encode(byte, 8)
 
         entry = int(tape[0])
         if entry == 0:
             raise ValueError("Not a valid file entry")
 
         etype = int(tape[1])
-        attrs = self._decode(tape[2:14])
-        index = self._decode(tape[14:24])
-        offset = self._decode(tape[24:32])
-        size = self._decode(tape[32:48])
-        ts = self._decode(tape[48:112])
+        attrs = cls._decode(tape[2:14])
+        index = cls._decode(tape[14:24])
+        offset = cls._decode(tape[24:32])
+        size = cls._decode(tape[32:48])
+        ts = cls._decode(tape[48:112])
 
         name = ""
-        for byte in tape[112:]:
+        for byte in raw[14:32]:
             if byte == 0:
                 continue
 
@@ -114,18 +222,19 @@ class FileEntry():
 
         else:
             obj.etype = etype
-            obj.attrs = attrs
             obj.index = index
             obj.offset = offset
             obj.size = size
             obj.name = name
 
+        obj.attrs = attrs
         obj.ts = ts
 
         return obj
 
-    def _encode(self, num, pad=None):
-        bits = list(bin(byte)[2:])
+    @staticmethod
+    def _encode(num, pad=None):
+        bits = list(bin(num)[2:])
         size = len(bits)
         if pad is not None:
             bits = leftpad(bits, pad)
@@ -137,23 +246,29 @@ class FileEntry():
 
         return bits
 
-    def _decode(self, bits):
-        return int("".join(bits, 2))
+    @staticmethod
+    def _decode(bits):
+        return int("".join(bits), 2)
 
-    def attach(self, sector):
+    def attach(self, sector, slot):
         self.sector = sector
+        self.slot = slot
 
     def attr(self, attr):
         self.attrs = self.attrs ^ attr
 
     def load(self):
-        raw = self.sector.read(self.offset, self.size)
+        error, raw = self.sector.read(self.slot, 32)
+        if error:
+            return True, raw
+
         FileEntry.init(raw, self)
+        return False, self
 
     def save(self):
         self.ts = int(time())
 
-        tape = ["0"] * 32
+        tape = ["0"] * 112
         tape[0] = "1"
         tape[1] = "1" if self.etype else "0"
 
@@ -163,15 +278,11 @@ class FileEntry():
         tape[32:48] = self._encode(self.size, 16)
         tape[48:112] = self._encode(self.ts, 64)
 
-        name = list()
-        for letter in name:
-            name.append(ord(letter))
-
-        tape[112:] = leftpad(name, 18, 0)
-
         raw = list()
-        for i in range(32):
+        for i in range(14):
             byte = self._decode(tape[i*8:(i+1)*8])
             raw.append(byte)
 
+        name = [ord(letter) for letter in self.name]
+        raw = raw + leftpad(name, 18, 0)
         return raw
@@ -2,9 +2,15 @@
 
 from ewenix.repl import REPL
 
+from sys import argv
+
 def main():
     repl = REPL()
-    repl.start()
+    if "--async" in argv[1:]:
+        repl.astart()
+
+    else:
+        repl.start()
 
 if __name__ == "__main__":
     main()
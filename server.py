@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+
+from ewenix.server import Server
+
+from sys import argv
+import asyncio
+
+def main():
+    port = int(argv[1]) if len(argv) > 1 else 7373
+    server = Server(port=port)
+    asyncio.run(server.forever())
+
+if __name__ == "__main__":
+    main()
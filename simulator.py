@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 
 from ewenix.repl import REPL
+from ewenix.algorithms import Memory, SlabAllocator, Storage, FileSystem
+from ewenix.algorithms import Block, bubble, sort_by
+from ewenix.encoding import BParser, bdump
 from ewenix.util import mint
 
 from time import perf_counter
-from random import randint
+from random import randint, shuffle
+from pathlib import Path
+from tempfile import TemporaryDirectory
 
 def main():
     repl = REPL()
 
     done, result = repl.execute("help")
     assert done is False, "Invalid help result 1"
-    assert len(result.split("\n")) == 10, "Invalid help result 2"
+    assert len(result.split("\n")) == 12, "Invalid help result 2"
 
     done, result = repl.execute("print hello world")
     assert done is False, "Invalid print result 1"
@@ -32,6 +37,13 @@ def main():
 
     print(f"Print Benchmark: {perf_counter()-timer1:.05f}s")
 
+    timer1a = perf_counter()
+    results = repl.execute_many(["print hello world"] * 1000)
+    assert len(results) == 1000, len(results)
+    assert results[-1] == (False, "hello world"), results[-1]
+
+    print(f"Print Batch Benchmark: {perf_counter()-timer1a:.05f}s")
+
     timer2 = perf_counter()
     for i in range(1000):
         done, result = repl.execute("quit")
@@ -49,7 +61,7 @@ def main():
         repl.execute(f"echo {j} {j}")
 
     prev = None
-    while len(repl.sched.queue) > 0:
+    while len(repl.sched) > 0:
         done, result = repl.process()
         value = mint(result, 0)
         assert done is False, "Invalid echo result 3"
@@ -61,6 +73,65 @@ def main():
     repl.sched.clear()
     print(f"Echo Benchmark: {perf_counter()-timer3:.05f}s")
 
+    timer3a = perf_counter()
+    wrepl = REPL(wheel=True)
+    for i in range(1000):
+        j = randint(1, 1000)
+        wrepl.execute(f"echo {j} {j}")
+
+    prev = None
+    while len(wrepl.sched) > 0:
+        done, result = wrepl.process()
+        value = mint(result, 0)
+        assert done is False, "Invalid wheel echo result"
+        if prev is not None:
+            assert value >= prev, f"{prev} > {value}"
+
+        prev = value
+
+    print(f"Wheel Echo Benchmark: {perf_counter()-timer3a:.05f}s")
+
+    timer3b = perf_counter()
+    for crepl in [REPL(), REPL(wheel=True)]:
+        expected = dict()
+        for i in range(300):
+            j = randint(1000, 2000)
+            done, result = crepl.execute(f"echo {j} {i}")
+            _, jobid, _, suspend = result.split()
+            expected[i] = mint(jobid, 0), mint(suspend, 0)
+
+        cancelled = set()
+        for i, (jobid, suspend) in expected.items():
+            if i % 3 == 0:
+                assert crepl.sched.cancel(jobid) is True, jobid
+                assert crepl.sched.cancel(jobid) is False, jobid
+                cancelled.add(i)
+
+            elif i % 5 == 0:
+                # NOTE - Pull these ahead of every job still waiting
+                suspend = suspend - randint(1001, 1500)
+                assert crepl.sched.reschedule(jobid, suspend) is True, jobid
+                expected[i] = jobid, suspend
+
+        assert len(crepl.sched) == 300 - len(cancelled), len(crepl.sched)
+
+        seen = list()
+        while len(crepl.sched) > 0:
+            done, result = crepl.process()
+            assert done is False, "Invalid cancel echo result"
+            seen.append(mint(result, 0))
+
+        assert len(seen) == 300 - len(cancelled), len(seen)
+        assert cancelled.isdisjoint(seen), cancelled.intersection(seen)
+
+        order = [expected[i][1] for i in seen]
+        assert order == sorted(order), "Rescheduled jobs ran out of order"
+
+        moved = [i for i in expected if i % 5 == 0 and i % 3 != 0]
+        assert set(seen[:len(moved)]) == set(moved), seen[:len(moved)]
+
+    print(f"Cancel Echo Benchmark: {perf_counter()-timer3b:.05f}s")
+
     timer4 = perf_counter()
 
     assert repl.mem.mem[0] == 0, repl.mem.mem[0]
@@ -95,9 +166,87 @@ def main():
     assert error is False, result
     assert result == [1,2,3,4], result
 
-    repl.mem.clear()
+    repl.slab.reset()
     print(f"Memory Benchmark: {perf_counter()-timer4:.05f}s")
 
+    timer4a = perf_counter()
+
+    # 32mb of memory is just over 1M blocks
+    mem = Memory(32*1024*1024)
+    pointers = list()
+    size = 8
+    while size > 0:
+        error, result = mem.alloc(randint(1, size), jobid=2)
+        if error:
+            # Fill in whatever gaps are left with smaller allocations
+            size = size // 2
+            continue
+
+        pointers.append(result)
+
+    assert mem.bitmap.count() == mem.blocks.size, mem.bitmap.count()
+
+    shuffle(pointers)
+    for pointer in pointers:
+        error, result = mem.free(pointer, jobid=2)
+        assert error is False, result
+
+    assert mem.bitmap.count() == 0, mem.bitmap.count()
+
+    error, result = mem.alloc(mem.blocks.size, jobid=2)
+    assert error is False, "Large memory did not coalesce"
+
+    print(f"Large Memory Benchmark: {perf_counter()-timer4a:.05f}s")
+
+    timer4b = perf_counter()
+
+    slab = SlabAllocator(repl.mem)
+    pointers = list()
+    for i in range(1000):
+        error, result = slab.alloc(4, jobid=2)
+        assert error is False, result
+        pointers.append(result)
+
+    stats = slab.stats()
+    assert stats[4]["objects"] == 1000, stats
+    assert stats[4]["requested"] == 4000, stats
+
+    for pointer in pointers:
+        error, result = slab.free(pointer, jobid=2)
+        assert error is False, result
+
+    assert len(slab.slabs) == 0, slab.slabs
+    assert repl.mem.bitmap.count() == 0, repl.mem.bitmap.count()
+
+    print(f"Slab Benchmark: {perf_counter()-timer4b:.05f}s")
+
+    # Fragment memory with every other block so a 2 block allocation fails
+    pointers = list()
+    for i in range(repl.mem.blocks.size):
+        error, result = repl.mem.alloc(1, jobid=2)
+        assert error is False, result
+        repl.mem.write(result, [i % 256], jobid=2)
+        pointers.append(result)
+
+    for pointer in pointers[::2]:
+        repl.mem.free(pointer, jobid=2)
+
+    error, result = repl.mem.alloc(2, jobid=2)
+    assert error is True, result
+
+    error, result = repl.mem.compact()
+    assert error is False, result
+    relocations = result["relocations"]
+    for i, pointer in enumerate(pointers[1::2]):
+        error, value = repl.mem.read(relocations[pointer], 1, jobid=2)
+        assert value == [(i*2+1) % 256], value
+
+    error, pointer = repl.mem.alloc(256, jobid=2)
+    assert error is False, pointer
+
+    repl.slab.reset()
+    print(f"Compact Benchmark: {result['time']:.05f}s ({result['moved']} bytes)")
+
     done, result = repl.execute("alloc 4", jobid=2)
     assert done is False, "Invalid alloc result 1"
     try:
@@ -107,6 +256,12 @@ def main():
         assert False, (result, e)
 
     pointer = result
+
+    # NOTE - Tiny REPL allocations are carved out of a shared slab
+    done, result = repl.execute("alloc 4", jobid=2)
+    assert result == pointer + 4, (pointer, result)
+    assert repl.slab.stats()[4]["objects"] == 2, repl.slab.stats()
+
     done, result = repl.execute(f"write {pointer} 1 2 3 4", jobid=2)
     assert done is False, "Invalid write result 1"
     assert isinstance(result, int), result
@@ -115,7 +270,7 @@ def main():
     assert done is False, "Invalid read result 1"
     assert result == [1,2,3,4], result
 
-    repl.mem.clear()
+    repl.slab.reset()
 
     raw = {"key": "value", "numbers": [1,2,3]}
     res = "d3:key5:value7:numbersli1ei2ei3eee"
@@ -140,7 +295,46 @@ def main():
     assert result == raw, result
 
     print(f"Bencode Benchmark: {perf_counter()-timer5:.05f}s")
-    repl.mem.clear()
+    repl.slab.reset()
+
+    timer5a = perf_counter()
+
+    # NOTE - Mirrors bfread pulling 32-byte sectors off of storage
+    value = {"key": "välue", "numbers": list(range(100)), "nested": [raw] * 10}
+    encoded = bytes(bdump(value) + bdump(raw))
+    parser = BParser()
+    values = list()
+    for i in range(0, len(encoded), 32):
+        values.extend(parser.feed(encoded[i:i+32]))
+
+    parser.close()
+    assert values == [value, raw], values
+
+    depth = 10000
+    encoded = b"l" * depth + b"i1e" + b"e" * depth
+    parser = BParser()
+    values = list()
+    for i in range(0, len(encoded), 32):
+        values.extend(parser.feed(encoded[i:i+32]))
+
+    assert len(values) == 1, values
+    value = values[0]
+    for i in range(depth):
+        assert isinstance(value, list) and len(value) == 1, (i, value)
+        value = value[0]
+
+    assert value == 1, value
+
+    parser = BParser()
+    parser.feed(b"d3:key5:val")
+    try:
+        parser.close()
+        assert False, "Parser closed mid-token"
+
+    except ValueError:
+        pass
+
+    print(f"Push Parser Benchmark: {perf_counter()-timer5a:.05f}s")
 
     timer6 = perf_counter()
 
@@ -153,5 +347,116 @@ def main():
 
     print(f"Run Benchmark: {perf_counter()-timer6:.05f}s")
 
+    repl.slab.reset()
+    repl.plans.clear()
+
+    timer7 = perf_counter()
+
+    plan = repl.compile("run write $1 1 2 3 4; read $1 4")
+    for i in range(1000):
+        error, pointer = repl.mem.alloc(1, jobid=3)
+        assert error is False, pointer
+
+        display, result = plan(repl, (pointer,), jobid=3)
+        assert result[1] == (True, [1,2,3,4]), result
+
+        error, result = repl.mem.free(pointer, jobid=3)
+        assert error is False, result
+
+    for i in range(1000):
+        repl.execute("run alloc 1; read 128 1")
+
+    stats = repl.plans.stats()
+    assert stats["hits"] == 999, stats
+    assert stats["misses"] == 2, stats
+
+    print(f"Plan Benchmark: {perf_counter()-timer7:.05f}s")
+
+    with TemporaryDirectory() as tmp:
+        timings = list()
+        for count in [1024, 16384]:
+            storage = Storage(count, 256, Path(tmp) / str(count))
+
+            timer8 = perf_counter()
+            fs = FileSystem(storage, count * 256)
+            timings.append(perf_counter() - timer8)
+            assert len(fs.paged) == 1, fs.paged
+            assert fs.root is None, fs.root
+
+            # NOTE - Lazy mounts only read sector 0 and the superblock
+            misses = storage.stats()["misses"]
+            assert misses == 2, (count, misses)
+
+            storage.close()
+
+        storage = Storage(1024, 256, Path(tmp) / "eager")
+
+        timer8a = perf_counter()
+        fs = FileSystem(storage, 1024 * 256, lazy=False)
+        assert len(fs.paged) == 1024, len(fs.paged)
+        assert len(fs.blocks) == 1, fs.blocks
+
+        print(f"Mount Benchmark: {timings[1]:.05f}s lazy, {perf_counter()-timer8a:.05f}s eager")
+
+        timer9 = perf_counter()
+        held = list()
+        for i in range(1000):
+            error, block = fs.alloc(randint(1, 150))
+            assert error is False, block
+            held.append(block)
+
+        shuffle(held)
+        for block in held[:500]:
+            error, result = fs.free(block)
+            assert error is False, result
+
+        error, result = fs.free(held[0])
+        assert error is True, "Invalid double free"
+
+        extents = dict(fs.index.extents)
+        fs.sync()
+        storage.close()
+
+        fs = FileSystem(storage, 1024 * 256)
+        assert fs.index.extents == extents, "Free index was not persisted"
+        assert len(fs.paged) == 1, len(fs.paged)
+
+        for block in held[500:]:
+            error, result = fs.free(block)
+            assert error is False, result
+
+        assert len(fs.blocks) == 1, fs.blocks
+
+        print(f"Free Index Benchmark: {perf_counter()-timer9:.05f}s")
+        storage.close()
+
+        # NOTE - A tiny cache makes the prefetcher evict sectors under alloc
+        storage = Storage(1024, 256, Path(tmp) / "prefetch", cache=2)
+        fs = FileSystem(storage, 1024 * 256, prefetch=True)
+        for i in range(300):
+            error, block = fs.alloc(7)
+            assert error is False, block
+
+        fs.prefetcher.join()
+        fs.sync()
+        extents = dict(fs.index.extents)
+        storage.close()
+
+        fs = FileSystem(storage, 1024 * 256)
+        assert fs.index.extents == extents, "Free index was not persisted"
+        fs.rebuild()
+        assert fs.index.extents == extents, "Bitmaps disagree with the free index"
+        storage.close()
+
+    blocks = [Block(randint(0, 1023), 32, randint(1, 224)) for _ in range(1000)]
+    expected = bubble(list(blocks), 2)
+
+    timer10 = perf_counter()
+    assert sort_by(list(blocks), "size") == expected, "Invalid sort_by result"
+    assert sort_by(blocks, 2, 10) == expected[:10], "Invalid sort_by top result"
+    assert sort_by(blocks, "size", 1, True)[0].size == expected[-1].size
+
+    print(f"Sort Benchmark: {perf_counter()-timer10:.05f}s")
+
 if __name__ == "__main__":
     main()